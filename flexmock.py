@@ -27,20 +27,36 @@ ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 __all__ = ['flexmock']
 
 
+import atexit
+import functools
+import hashlib
 import inspect
+import json
+import os
 import re
+import struct
 import sys
+import threading
 import types
+import weakref
+
+from collections import deque
 
 
 AT_LEAST = 'at least'
 AT_MOST = 'at most'
 EXACTLY = 'exactly'
+UNLIMITED_CALLS = sys.maxsize
 UPDATED_ATTRS = ['should_receive', 'should_call', 'new_instances']
 DEFAULT_CLASS_ATTRIBUTES = [attr for attr in dir(type)
                             if attr not in dir(type('', (object,), {}))]
 RE_TYPE = re.compile('')
+_NO_RETURN_VALUES = ()
+_MISSING = object()
 SPECIAL_METHODS = (classmethod, staticmethod)
+_never = lambda func: False
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', _never)
+_isasyncgenfunction = getattr(inspect, 'isasyncgenfunction', _never)
 
 
 try:
@@ -85,7 +101,57 @@ class CallOrderError(FlexmockError):
   pass
 
 
+class ForkedCallError(FlexmockError):
+  pass
+
+
+class Arguments(object):
+  """Positional and keyword arguments of a call or of with_args().
+
+  Item access is supported as well so that code written for the plain
+  {'kargs': ..., 'kwargs': ...} dicts keeps working.
+  """
+  __slots__ = ('kargs', 'kwargs')
+
+  def __init__(self, kargs=(), kwargs=None):
+    self.kargs = kargs
+    if kwargs is None:
+      kwargs = {}
+    self.kwargs = kwargs
+
+  def __getitem__(self, key):
+    if key not in Arguments.__slots__:
+      raise KeyError(key)
+    return getattr(self, key)
+
+  def __setitem__(self, key, value):
+    if key not in Arguments.__slots__:
+      raise KeyError(key)
+    setattr(self, key, value)
+
+  def __eq__(self, other):
+    if isinstance(other, Arguments):
+      return self.kargs == other.kargs and self.kwargs == other.kwargs
+    if isinstance(other, dict):
+      return other == {'kargs': self.kargs, 'kwargs': self.kwargs}
+    return NotImplemented
+
+  def __ne__(self, other):
+    equal = self.__eq__(other)
+    if equal is NotImplemented:
+      return equal
+    return not equal
+
+  # mutable, like the dicts it replaces
+  __hash__ = None
+
+  def __repr__(self):
+    return repr({'kargs': self.kargs, 'kwargs': self.kwargs})
+
+
 class ReturnValue(object):
+  __slots__ = ('value', 'raises')
+
   def __init__(self, value=None, raises=None):
     self.value = value
     self.raises = raises
@@ -102,6 +168,220 @@ class ReturnValue(object):
         return '(%s)' % ', '.join([_arg_to_str(x) for x in self.value])
 
 
+class ReturnValueQueue(deque):
+  """Return values of an expectation, cycled through on successive calls.
+
+  Taking the next value rotates the queue in constant time, and the number
+  of values handed out so far is kept in the consumed attribute.
+  """
+  __slots__ = ('consumed', '_values')
+
+  def __init__(self, values=()):
+    deque.__init__(self, values)
+    self.consumed = 0
+    self._values = ()
+
+  def next_value(self):
+    """Returns the value at the head of the queue and moves it to the back."""
+    value = self[0]
+    self.rotate(-1)
+    self.consumed += 1
+    return value
+
+  def take_value(self, lock):
+    """Same as next_value() but safe to call from several threads at once.
+
+    Rather than rotating the queue, each caller is handed out a position of
+    its own while holding lock, which belongs to the expectation. Values are
+    picked by position modulo the number of values, so ones added after
+    calls were made don't come up in the order rotating would give.
+    """
+    lock.acquire()
+    try:
+      position = self.consumed
+      self.consumed = position + 1
+    finally:
+      lock.release()
+    return self.value_at(position)
+
+  def value_at(self, position):
+    """Returns the value at position, wrapping around, in constant time."""
+    values = self._values
+    if len(values) != len(self):
+      # indexing a deque away from its ends is linear, so keep a list of
+      # the values, taken again whenever some are added
+      values = self._values = list(self)
+    return values[position % len(values)]
+
+
+class _CallCounter(object):
+  """Counts calls made from several threads without them sharing a counter.
+
+  Each thread increments a cell of its own and the cells are only added up
+  when the total is asked for, e.g. by Expectation.verify().
+  """
+  __slots__ = ('_local', '_cells', '_lock')
+
+  def __init__(self):
+    self._local = threading.local()
+    self._cells = []
+    self._lock = threading.Lock()
+
+  def add(self):
+    try:
+      cell = self._local.cell
+    except AttributeError:
+      cell = self._local.cell = [0]
+      self._cells.append(cell)
+    cell[0] += 1
+
+  def total(self):
+    return sum([cell[0] for cell in self._cells])
+
+  def take_value(self, return_values):
+    return return_values.take_value(self._lock)
+
+
+class _SharedCallCounter(object):
+  """Counts calls in shared memory so calls made by forked children add up.
+
+  The calls and the position of the next return value live in a small
+  multiprocessing.shared_memory segment, inherited by processes forked after
+  the expectation was created, which the creating process removes once the
+  counter goes away.
+  """
+  __slots__ = ('_memory', '_lock', '__weakref__')
+  _SLOT = struct.Struct('q')
+  _CALLS, _CURSOR = 0, _SLOT.size
+
+  def __init__(self):
+    try:
+      import multiprocessing
+      from multiprocessing import shared_memory
+    except ImportError:
+      raise FlexmockError(
+          'shared_memory_calls requires multiprocessing.shared_memory')
+    self._memory = shared_memory.SharedMemory(
+        create=True, size=2 * self._SLOT.size)
+    self._memory.buf[:] = bytes(len(self._memory.buf))
+    self._lock = multiprocessing.Lock()
+    weakref.finalize(self, _release_shared_memory, self._memory, os.getpid())
+
+  def _increment(self, offset):
+    buf = self._memory.buf
+    with self._lock:
+      value = self._SLOT.unpack_from(buf, offset)[0]
+      self._SLOT.pack_into(buf, offset, value + 1)
+    return value
+
+  def add(self):
+    self._increment(self._CALLS)
+
+  def total(self):
+    return self._SLOT.unpack_from(self._memory.buf, self._CALLS)[0]
+
+  def take_value(self, return_values):
+    return return_values.value_at(self._increment(self._CURSOR))
+
+
+def _release_shared_memory(memory, pid):
+  memory.close()
+  if os.getpid() == pid:
+    memory.unlink()
+
+
+class _ResolvedAwaitable(object):
+  """Result of a mocked coroutine function, available as soon as awaited.
+
+  Awaiting it finishes on the first step so the event loop never has to
+  schedule anything, unlike a coroutine that would return the same value.
+  """
+  __slots__ = ('value', 'exception')
+
+  def __init__(self, value=None, exception=None):
+    self.value = value
+    self.exception = exception
+
+  def __await__(self):
+    return self
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if self.exception is not None:
+      raise self.exception
+    raise StopIteration(self.value)
+  next = __next__
+
+  def send(self, value):
+    return self.__next__()
+
+  def throw(self, exc_type, value=None, traceback=None):
+    if value is None:
+      value = exc_type
+    raise value
+
+  def close(self):
+    pass
+
+
+class _CheckedAwaitable(object):
+  """Awaits a spied on coroutine and checks its result like _pass_thru()."""
+  __slots__ = ('expectation', 'iterator')
+
+  def __init__(self, expectation, awaitable):
+    self.expectation = expectation
+    self.iterator = awaitable.__await__()
+
+  def __await__(self):
+    return self
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    return self.send(None)
+  next = __next__
+
+  def send(self, value):
+    return self._step(self.iterator.send, value)
+
+  def throw(self, *exc_info):
+    return self._step(self.iterator.throw, *exc_info)
+
+  def close(self):
+    close = getattr(self.iterator, 'close', None)
+    if close is not None:
+      close()
+
+  def _step(self, step, *args):
+    try:
+      return step(*args)
+    except StopIteration:
+      return_value = _check_return_value(
+          self.expectation, sys.exc_info()[1].value)
+    except:
+      return_value = _handle_exception_matching(self.expectation)
+    raise StopIteration(return_value)
+
+
+class _AsyncIterator(object):
+  """Async iterator over the values given to and_yield()."""
+  __slots__ = ('values',)
+
+  def __init__(self, values):
+    self.values = iter(values)
+
+  def __aiter__(self):
+    return self
+
+  def __anext__(self):
+    for value in self.values:
+      return _ResolvedAwaitable(value)
+    raise StopAsyncIteration
+
+
 class FullArgSpec(object):
   """Silly hack for inpsect.getargspec return a tuple on python <2.6"""
   def __init__(self, spec):
@@ -110,45 +390,496 @@ class FullArgSpec(object):
     (self.args, self.varargs, self.keywords, self.defaults, self.kwonlyargs,
      self.kwonlydefaults, self.annotations) = spec
 
-class FlexmockContainer(object):
-  """Holds global hash of object/expectation mappings."""
-  flexmock_objects = {}
-  properties = {}
-  ordered = []
-  last = None
+class ArgumentsMatcher(object):
+  """Matcher for the arguments given to with_args(), compiled once.
+
+  Expected arguments are kept in their normalized form, i.e. positional
+  arguments are keyed by their name in the mocked function's signature when
+  it is known, and each one is tagged with the kind of check it needs. This
+  way matching a call is a single pass over the given arguments.
+  """
+  __slots__ = ('positional_names', 'kargs', 'kwargs', 'kwarg_names')
+  EQUAL, CLASS, REGEX = 0, 1, 2
+
+  def __init__(self, expected_args, positional_names=None):
+    self.positional_names = positional_names
+    self.kargs = tuple([_compile_argument(arg)
+                        for arg in expected_args['kargs']])
+    self.kwargs = dict([(name, _compile_argument(arg))
+                        for name, arg in expected_args['kwargs'].items()])
+    self.kwarg_names = frozenset(self.kwargs)
+
+  def match(self, kargs, kwargs):
+    """Check if the given call arguments match the expected ones."""
+    names = self.positional_names
+    if names is not None and len(kargs) <= len(names):
+      return self._match_named(kargs, kwargs, names)
+    expected = self.kargs
+    if (len(kargs) != len(expected) or len(kwargs) != len(self.kwargs) or
+        (kwargs and self.kwarg_names.symmetric_difference(kwargs))):
+      return False
+    for i in range(len(kargs)):
+      if not _argument_matches(kargs[i], expected[i]):
+        return False
+    if kwargs:
+      expected = self.kwargs
+      for name, arg in kwargs.items():
+        if not _argument_matches(arg, expected[name]):
+          return False
+    return True
+
+  def _match_named(self, kargs, kwargs, names):
+    """Match a call whose positional arguments all have names."""
+    if self.kargs:
+      return False
+    expected = self.kwargs
+    given_len = len(kargs)
+    if kwargs:
+      # a positional argument takes precedence over a keyword argument
+      # given for the same name
+      positional = names[:given_len]
+      for name, arg in kwargs.items():
+        if name in positional:
+          continue
+        if name not in expected or not _argument_matches(arg, expected[name]):
+          return False
+        given_len += 1
+    if given_len != len(expected):
+      return False
+    for i in range(len(kargs)):
+      name = names[i]
+      if name not in expected or not _argument_matches(kargs[i], expected[name]):
+        return False
+    return True
+
+
+class SignatureInfo(object):
+  """Validation data precomputed from the argspec of a mocked function."""
+
+  def __init__(self, argspec):
+    self.argspec = argspec
+    args = tuple(argspec.args)
+    self.positional_names = args
+    self.bound_positional_names = args[1:]
+    self.positional_name_set = frozenset(args)
+    self.allowed_kwargs = frozenset(args + tuple(argspec.kwonlyargs))
+    self.defaults_len = len(argspec.defaults or ())
+    if self.defaults_len:
+      self.optional_names = frozenset(args[len(args) - self.defaults_len:])
+    else:
+      self.optional_names = frozenset()
+    self.accepts_any_kwargs = argspec.keywords is not None
+    self.min_args = len(args) - self.defaults_len
+    if argspec.varargs is None and argspec.keywords is None:
+      self.max_args = len(args)
+    else:
+      self.max_args = None
+    self.required_kwonlyargs = tuple([
+        a for a in argspec.kwonlyargs
+        if a not in (argspec.kwonlydefaults or {})])
+
+
+# signatures are keyed on code objects which are shared by every function
+# created from the same def statement, e.g. classes defined inside tests
+_signature_cache = weakref.WeakKeyDictionary()
+
+
+def _get_signature(original):
+  """Returns the (cached) SignatureInfo of original or None for builtins."""
+  code = None
+  if inspect.isfunction(original) or inspect.ismethod(original):
+    # argspecs of bound methods include self, same as their functions
+    function = getattr(original, '__func__', original)
+    function_dict = getattr(function, '__dict__', {})
+    # decorator wrappers share their code but report the signature of the
+    # function they wrap, so those aren't cached
+    if not ('__signature__' in function_dict or
+            '__wrapped__' in function_dict):
+      code = getattr(function, '__code__', None)
+    signature = code is not None and _signature_cache.get(code)
+    if (signature and
+        signature.defaults_len == len(function.__defaults__ or ())):
+      return signature
+  argspec = None
+  if code is not None and _introspection_cache is not None:
+    argspec = _introspection_cache.get_argspec(code, function)
+  if argspec is None:
+    try:
+      if sys.version_info < (3, 0):
+        argspec = FullArgSpec(inspect.getargspec(original))
+      else:
+        argspec = FullArgSpec(inspect.getfullargspec(original))
+    except TypeError:
+      # built-in function: fall back to stupid processing and hope the
+      # builtins don't change signature
+      return None
+    if code is not None and _introspection_cache is not None:
+      _introspection_cache.store_argspec(code, argspec)
+  signature = SignatureInfo(argspec)
+  if code is not None:
+    try:
+      _signature_cache[code] = signature
+    except TypeError:  # code objects can't be weakly referenced
+      pass
+  return signature
+
+
+class IntrospectionCache(object):
+  """On-disk cache of the argspecs of mocked functions.
+
+  Argspecs are stored in one JSON file per source module and are only used
+  while the module's mtime and size stay the same. Default values aren't
+  stored, they are always taken from the function itself.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    self.modules = {}
+    self.modified = set()
+
+  def get_argspec(self, code, function):
+    module = self._get_module(code.co_filename)
+    if module is None:
+      return None
+    spec = module['argspecs'].get(self._key(code))
+    defaults = function.__defaults__
+    if spec is None or spec[3] != len(defaults or ()):
+      return None
+    args, varargs, keywords, _, kwonlyargs = spec
+    # the names must be those of the code, in the order it keeps them
+    names = args + kwonlyargs + [n for n in (varargs, keywords) if n]
+    if list(code.co_varnames[:len(names)]) != names:
+      return None
+    return FullArgSpec((args, varargs, keywords, defaults, kwonlyargs,
+                        getattr(function, '__kwdefaults__', None), {}))
+
+  def store_argspec(self, code, argspec):
+    module = self._get_module(code.co_filename)
+    if module is None:
+      return
+    module['argspecs'][self._key(code)] = [
+        list(argspec.args), argspec.varargs, argspec.keywords,
+        len(argspec.defaults or ()), list(argspec.kwonlyargs)]
+    self.modified.add(code.co_filename)
+
+  def save(self):
+    """Writes out the modules whose entries changed since they were loaded."""
+    if not self.modified:
+      return
+    try:
+      os.makedirs(self.directory)
+    except OSError:
+      if not os.path.isdir(self.directory):
+        return
+    for filename in self.modified:
+      path = self._path(filename)
+      tmp_path = '%s.%s.tmp' % (path, os.getpid())
+      try:
+        f = open(tmp_path, 'w')
+        try:
+          json.dump(self.modules[filename], f)
+        finally:
+          f.close()
+        if hasattr(os, 'replace'):
+          os.replace(tmp_path, path)
+        else:
+          os.rename(tmp_path, path)
+      except (IOError, OSError, TypeError, ValueError):
+        pass
+    self.modified = set()
+
+  def _get_module(self, filename):
+    if filename in self.modules:
+      return self.modules[filename]
+    try:
+      stat = os.stat(filename)
+    except (OSError, TypeError, ValueError):
+      # dynamically generated code, e.g. <string>
+      self.modules[filename] = None
+      return None
+    stamp = [stat.st_mtime, stat.st_size]
+    module = None
+    try:
+      f = open(self._path(filename))
+      try:
+        module = json.load(f)
+      finally:
+        f.close()
+      if module.get('filename') != filename or module.get('stamp') != stamp:
+        module = None
+    except (IOError, OSError, ValueError, AttributeError):
+      module = None
+    if module is None:
+      module = {'filename': filename, 'stamp': stamp, 'argspecs': {}}
+    self.modules[filename] = module
+    return module
+
+  def _key(self, code):
+    # functions defined on the same line, e.g. lambdas, differ in their
+    # qualified names (3.11+) or arguments
+    nargs = code.co_argcount + getattr(code, 'co_kwonlyargcount', 0)
+    return '%s:%s:%s' % (getattr(code, 'co_qualname', code.co_name),
+                         code.co_firstlineno,
+                         ','.join(code.co_varnames[:nargs]))
+
+  def _path(self, filename):
+    name = hashlib.sha1(filename.encode('utf-8')).hexdigest()
+    return os.path.join(self.directory, '%s.json' % name)
+
+
+_introspection_cache = None
+
+
+def enable_introspection_cache(directory=None):
+  """Persists introspected function signatures between test runs.
+
+  Args:
+    - directory: where to keep the cache files, defaults to the flexmock
+                 directory inside .pytest_cache in the current directory
+
+  Returns:
+    IntrospectionCache object, saved automatically at interpreter exit
+  """
+  global _introspection_cache
+  if directory is None:
+    directory = os.path.join(os.getcwd(), '.pytest_cache', 'd', 'flexmock')
+  if _introspection_cache is not None:
+    _introspection_cache.save()
+  _introspection_cache = IntrospectionCache(directory)
+  atexit.register(_introspection_cache.save)
+  return _introspection_cache
+
+
+def disable_introspection_cache():
+  """Saves and stops using the cache set up by enable_introspection_cache."""
+  global _introspection_cache
+  if _introspection_cache is not None:
+    _introspection_cache.save()
+    _introspection_cache = None
+
+
+try:
+  from contextvars import ContextVar
+except ImportError:  # python < 3.7
+  class ContextVar(object):
+    """Stand-in for contextvars.ContextVar binding values per thread."""
+
+    def __init__(self, name, default):
+      self._default = default
+      self._local = threading.local()
+
+    def get(self):
+      return getattr(self._local, 'value', self._default)
+
+    def set(self, value):
+      token = getattr(self._local, 'value', _MISSING)
+      self._local.value = value
+      return token
+
+    def reset(self, token):
+      if token is _MISSING:
+        del self._local.value
+      else:
+        self._local.value = token
+
+
+class _ContainerState(object):
+  """Expectations and changes tracked by FlexmockContainer in one context."""
+  __slots__ = (
+      'flexmock_objects', 'mocks_by_object', 'expectations_by_name',
+      'mock_methods', 'compacted', 'journal', 'journaled', 'module_changes',
+      'ordered', 'next_ordered', 'last', 'scopes', 'added_mocks',
+      'added_expectations')
+
+  def __init__(self):
+    self.flexmock_objects = {}
+    self.mocks_by_object = {}
+    self.expectations_by_name = {}
+    self.mock_methods = {}
+    self.compacted = set()
+    self.journal = []
+    self.journaled = {}
+    self.module_changes = []
+    self.ordered = []
+    self.next_ordered = 0
+    self.last = None
+    # open scope()s and what was added since, to roll back to their savepoints
+    self.scopes = []
+    self.added_mocks = []
+    self.added_expectations = []
+
+
+# contexts (threads, asyncio tasks...) share one state unless bound their own
+_container_state = ContextVar('flexmock_container', default=_ContainerState())
+
+
+class _ContainerType(type):
+  """Resolves FlexmockContainer's state attributes in the current context."""
+
+
+def _container_state_property(name):
+  def get(cls):
+    return getattr(_container_state.get(), name)
+  def set(cls, value):
+    setattr(_container_state.get(), name, value)
+  return property(get, set)
+
+for _name in _ContainerState.__slots__:
+  setattr(_ContainerType, _name, _container_state_property(_name))
+
+
+class FlexmockContainer(_ContainerType('_ContainerBase', (object,), {})):
+  """Holds global hash of object/expectation mappings.
+
+  The mappings are kept per context, see bind().
+  """
+  # stubs of instances moved to generated subclasses, see instance_subclasses
+  instance_overrides = {}
+  # when a call matches no expectation, undo every change rather than just
+  # those made to modules (e.g. builtins) before raising
+  full_reset_on_unmatched_call = False
+  # return a separate Mock handle from flexmock(obj) rather than adding
+  # should_receive() etc. to obj itself
+  partial_mock_handles = False
+  # stub attributes of instances on a generated subclass the instance is
+  # moved to, rather than in its __dict__ and, for magic methods, its class
+  instance_subclasses = False
+  # count calls and hand out return values safely when mocks are called
+  # from several threads at once, applies to expectations created after
+  thread_safe_calls = False
+  # like thread_safe_calls but also counting calls made by processes forked
+  # after the expectation was created, requires Python 3.8+
+  shared_memory_calls = False
+  # run the call phase of each pytest test in a forked child, see run_forked()
+  fork_per_test = False
 
   @classmethod
   def reset(cls):
     cls.ordered = []
+    cls.next_ordered = 0
     cls.last = None
     cls.flexmock_objects = {}
-    cls.properties = {}
+    cls.mocks_by_object = {}
+    cls.expectations_by_name = {}
+    cls.mock_methods = {}
+    cls.compacted = set()
+    cls.journal = []
+    cls.journaled = {}
+    cls.module_changes = []
+    cls.added_mocks = []
+    cls.added_expectations = []
+
+  @classmethod
+  def bind(cls):
+    """Gives the current context a container of its own.
+
+    On Python 3.7+ contexts are threads, asyncio tasks and greenlets, on
+    older versions only threads. Mock methods keep using the container
+    they were created in when called from other contexts.
+
+    Returns:
+      token to pass to unbind()
+    """
+    return _container_state.set(_ContainerState())
+
+  @classmethod
+  def unbind(cls, token):
+    """Switches back to the container used before bind() returned token."""
+    _container_state.reset(token)
+
+  @classmethod
+  def savepoint(cls):
+    """Marks the current state to roll back to with rollback()."""
+    return (len(cls.journal), len(cls.added_mocks),
+            len(cls.added_expectations), len(cls.ordered))
+
+  @classmethod
+  def rollback(cls, savepoint):
+    """Undoes changes and drops expectations made since the savepoint.
+
+    Returns:
+      expectations that were dropped, to be verified
+    """
+    journal_len, mocks_len, expectations_len, ordered_len = savepoint
+    journal = cls.journal
+    while len(journal) > journal_len:
+      change = journal.pop()
+      if change is not None:
+        cls.journaled.pop((id(change[0]), change[1]), None)
+        _restore_attribute(*change)
+    while cls.module_changes and cls.module_changes[-1] >= journal_len:
+      cls.module_changes.pop()
+    dropped = cls.added_expectations[expectations_len:]
+    del cls.added_expectations[expectations_len:]
+    for mock, expectation in reversed(dropped):
+      cls.flexmock_objects[mock].pop()
+      key = (mock, expectation.name)
+      expectations = cls.expectations_by_name[key]
+      if (key not in cls.compacted and expectations and
+          expectations[-1] is expectation):
+        expectations.pop()
+      else:
+        # the index may be missing expectations shadowed by the dropped one
+        cls.compacted.discard(key)
+        expectations[:] = [
+            e for e in cls.flexmock_objects[mock] if e.name == expectation.name]
+        cls._compact(key, expectations)
+      if not expectations:
+        del cls.expectations_by_name[key]
+        cls.mock_methods.pop(key, None)
+    for mock in reversed(cls.added_mocks[mocks_len:]):
+      del cls.flexmock_objects[mock]
+      if cls.mocks_by_object.get(id(mock._object)) is mock:
+        del cls.mocks_by_object[id(mock._object)]
+    del cls.added_mocks[mocks_len:]
+    # calls made since to ordered expectations that are kept still count
+    if cls.next_ordered > ordered_len:
+      cls.next_ordered = ordered_len
+      if ordered_len:
+        cls.last = cls.ordered[ordered_len - 1]
+      else:
+        cls.last = None
+    del cls.ordered[ordered_len:]
+    return [expectation for _, expectation in dropped]
 
   @classmethod
   def get_flexmock_expectation(cls, obj, name=None, args=None):
     """Retrieves an existing matching expectation."""
-    if args == None:
-      args = {'kargs': (), 'kwargs': {}}
-    if not isinstance(args, dict):
-      args = {'kargs': args, 'kwargs': {}}
-    if not isinstance(args['kargs'], tuple):
-      args['kargs'] = (args['kargs'],)
-    if name and obj in cls.flexmock_objects:
+    if args is None:
+      args = Arguments()
+    elif isinstance(args, dict):
+      args = Arguments(args['kargs'], args['kwargs'])
+    elif not isinstance(args, Arguments):
+      args = Arguments(args)
+    if not isinstance(args.kargs, tuple):
+      args.kargs = (args.kargs,)
+    if name:
+      state = _container_state.get()
+      expectations = state.expectations_by_name.get((obj, name), ())
+      if not state.ordered:
+        for e in reversed(expectations):
+          if e.match_args(args):
+            return e
+        return None
       found = None
-      for e in reversed(cls.flexmock_objects[obj]):
-        if e.name == name and e.match_args(args):
-          if e in cls.ordered or not e._ordered and not found:
+      for e in reversed(expectations):
+        if e._ordered:
+          # only ordered expectations that haven't been called yet qualify
+          if e._order_index >= state.next_ordered and e.match_args(args):
             found = e
+        elif not found and e.match_args(args):
+          found = e
       if found and found._ordered:
         cls._verify_call_order(found, args)
       return found
 
   @classmethod
   def _verify_call_order(cls, expectation, args):
-    if not cls.ordered:
+    if cls.next_ordered >= len(cls.ordered):
       next_method = cls.last
     else:
-      next_method = cls.ordered.pop(0)
+      next_method = cls.ordered[cls.next_ordered]
+      cls.next_ordered += 1
       cls.last = next_method
     if expectation is not next_method:
       raise CallOrderError(
@@ -156,25 +887,129 @@ class FlexmockContainer(object):
           (_format_args(expectation.name, args),
            _format_args(next_method.name, next_method.args)))
 
+  @classmethod
+  def add_ordered(cls, expectation):
+    """Appends to the call order, returning the expectation's position."""
+    cls.ordered.append(expectation)
+    return len(cls.ordered) - 1
+
+  @classmethod
+  def add_mock(cls, mock):
+    if mock not in cls.flexmock_objects:
+      cls.flexmock_objects[mock] = []
+      cls.added_mocks.append(mock)
+      # keyed by id() as mocked objects aren't necessarily hashable, the
+      # mock keeps the object alive so the id can't be reused meanwhile
+      cls.mocks_by_object.setdefault(id(mock._object), mock)
+
   @classmethod
   def add_expectation(cls, obj, expectation):
-    if obj in cls.flexmock_objects:
-      cls.flexmock_objects[obj].append(expectation)
+    if obj not in cls.flexmock_objects:
+      cls.add_mock(obj)
+    cls.flexmock_objects[obj].append(expectation)
+    cls.added_expectations.append((obj, expectation))
+    # secondary index so that call dispatch only looks at expectations
+    # defined for the method actually being called
+    key = (obj, expectation.name)
+    expectations = cls.expectations_by_name.get(key)
+    if expectations is None:
+      cls.expectations_by_name[key] = [expectation]
+    else:
+      cls._compact(key, expectations)
+      expectations.append(expectation)
+
+  @classmethod
+  def _compact(cls, key, expectations):
+    """Drops expectations that can no longer be matched from the index.
+
+    Calls are dispatched to the most recently defined unordered expectation
+    that matches, so unordered expectations defined before a catch-all one
+    (no with_args() and not ordered) are never picked again. They stay in
+    flexmock_objects so their times() constraints are still verified.
+    """
+    for i in range(len(expectations) - 1, 0, -1):
+      e = expectations[i]
+      if e._matcher is None and not e._ordered:
+        break
     else:
-      cls.flexmock_objects[obj] = [expectation]
+      return
+    kept = [e for e in expectations[:i] if e._ordered]
+    if len(kept) < i:
+      expectations[:i] = kept
+      cls.compacted.add(key)
+
+  @classmethod
+  def restore_compacted(cls, expectation):
+    """Rebuilds the index for an expectation whose matching just changed.
+
+    Adding arguments or ordering to an expectation can make the ones it
+    shadowed reachable again, so they are put back in definition order.
+    """
+    mock = cls.mocks_by_object.get(id(expectation._mock))
+    key = (mock, expectation.name)
+    if key in cls.compacted:
+      cls.compacted.discard(key)
+      cls.expectations_by_name[key] = [
+          e for e in cls.flexmock_objects[mock] if e.name == expectation.name]
 
   @classmethod
-  def add_teardown_property(cls, obj, name):
-    if obj in cls.properties:
-      cls.properties[obj].append(name)
+  def capture_state(cls, obj, name):
+    """Captures the state of an attribute flexmock is about to change.
+
+    Returns None if the attribute has already been changed, as only its
+    state before the first change needs to be restored.
+    """
+    if (id(obj), name) in cls.journaled:
+      return None
+    obj_dict = getattr(obj, '__dict__', None)
+    if obj_dict is not None:
+      local = name in obj_dict
+      previous = obj_dict.get(name)
     else:
-      cls.properties[obj] = [name]
+      previous = getattr(obj, name, _MISSING)
+      local = previous is not _MISSING
+    return (obj, name, local, previous)
+
+  @classmethod
+  def record_change(cls, state):
+    """Journals a change made to the attribute captured by capture_state."""
+    obj, name = state[:2]
+    cls.journaled[(id(obj), name)] = len(cls.journal)
+    if isinstance(obj, types.ModuleType):
+      cls.module_changes.append(len(cls.journal))
+    cls.journal.append(state)
+
+  @classmethod
+  def undo_change(cls, obj, name):
+    """Restores a single journaled attribute to its original state."""
+    index = cls.journaled.pop((id(obj), name), None)
+    if index is not None:
+      change = cls.journal[index]
+      cls.journal[index] = None
+      _restore_attribute(*change)
+
+  @classmethod
+  def undo_changes(cls):
+    """Restores all journaled attributes, most recent change first."""
+    journal = cls.journal
+    cls.journal = []
+    cls.journaled = {}
+    cls.module_changes = []
+    for change in reversed(journal):
+      if change is not None:
+        _restore_attribute(*change)
 
   @classmethod
-  def teardown_properties(cls):
-    for obj, names in cls.properties.items():
-      for name in names:
-        delattr(obj, name)
+  def undo_module_changes(cls):
+    """Restores journaled module attributes only, e.g. builtins like open()."""
+    module_changes = cls.module_changes
+    cls.module_changes = []
+    for index in reversed(module_changes):
+      change = cls.journal[index]
+      if change is not None:
+        cls.journal[index] = None
+        del cls.journaled[(id(change[0]), change[1])]
+        _restore_attribute(*change)
 
 
 class Expectation(object):
@@ -184,60 +1019,81 @@ class Expectation(object):
   its argument list, return values, and any exceptions that the method might
   raise.
   """
+  __slots__ = (
+      'name', 'modifier', 'original', 'original_function', 'args',
+      '_matcher', 'method_type', 'argspec', '_signature', 'return_values',
+      '_replace_with', '_times_called', '_call_counter', '_expected_calls',
+      '_min_calls', '_max_calls', 'runnable', '_mock', '_pass_thru',
+      '_ordered', '_order_index', '_one_by_one', '_verified', '_callable',
+      '_coroutine')
 
   def __init__(self, mock, name=None, return_value=None, original=None):
     self.name = name
     self.modifier = EXACTLY
-    if original is not None:
-      self.original = original
+    self.original = original
+    self.original_function = None
     self.args = None
+    self._matcher = None
     self.method_type = types.MethodType
     self.argspec = None
-    value = ReturnValue(return_value)
-    self.return_values = return_values = []
-    self._replace_with = None
+    self._signature = None
     if return_value is not None:
-      return_values.append(value)
-    self.times_called = 0
-    self.expected_calls = {
-        EXACTLY: None,
-        AT_LEAST: None,
-        AT_MOST: None}
-    self.runnable = lambda: True
+      self.return_values = ReturnValueQueue([ReturnValue(return_value)])
+    else:
+      self.return_values = _NO_RETURN_VALUES
+    self._replace_with = None
+    self._times_called = 0
+    if FlexmockContainer.shared_memory_calls:
+      self._call_counter = _SharedCallCounter()
+    elif FlexmockContainer.thread_safe_calls:
+      self._call_counter = _CallCounter()
+    else:
+      self._call_counter = None
+    self._expected_calls = None
+    self._min_calls = 0
+    self._max_calls = UNLIMITED_CALLS
+    self.runnable = _always_runnable
     self._mock = mock
     self._pass_thru = False
     self._ordered = False
+    self._order_index = -1
     self._one_by_one = False
     self._verified = False
     self._callable = True
-    self._local_override = False
+    self._coroutine = False
 
   def __str__(self):
     return '%s -> (%s)' % (_format_args(self.name, self.args),
                            ', '.join(['%s' % x for x in self.return_values]))
 
   def __call__(self):
+    """Makes once, ordered, at_least etc. work with and without parens."""
     return self
 
-  def __getattribute__(self, name):
-    if name == 'once':
-      return _getattr(self, 'times')(1)
-    elif name == 'twice':
-      return _getattr(self, 'times')(2)
-    elif name == 'never':
-      return _getattr(self, 'times')(0)
-    elif name in ('at_least', 'at_most', 'ordered', 'one_by_one'):
-      return _getattr(self, name)()
-    elif name == 'mock':
-      return _getattr(self, 'mock')()
-    else:
-      return _getattr(self, name)
-
   def __getattr__(self, name):
     self.__raise(
         AttributeError,
         "'%s' object has not attribute '%s'" % (self.__class__.__name__, name))
 
+  @property
+  def times_called(self):
+    """Number of times the expectation has been called."""
+    if self._call_counter is not None:
+      return self._times_called + self._call_counter.total()
+    return self._times_called
+
+  @property
+  def expected_calls(self):
+    """Number of calls expected by times(), keyed by the modifier used."""
+    if self._expected_calls is None:
+      self._expected_calls = {EXACTLY: None, AT_LEAST: None, AT_MOST: None}
+    return self._expected_calls
+
+  def _add_return_values(self, *values):
+    if self.return_values is _NO_RETURN_VALUES:
+      self.return_values = ReturnValueQueue()
+    self.return_values.extend(values)
+
   def _get_runnable(self):
     """Ugly hack to get the name of when() condition from the source code."""
     name = 'condition'
@@ -254,24 +1110,24 @@ class Expectation(object):
   def _verify_signature_match(self, *kargs, **kwargs):
     if isinstance(self._mock, Mock):
       return  # no sense in enforcing this for fake objects
-    allowed = self.argspec
+    signature = self._signature
     # TODO(herman): fix it properly so that module mocks aren't set as methods
     is_method = (inspect.ismethod(getattr(self._mock, self.name)) and
                  self.method_type is not staticmethod and
                  type(self._mock) != types.ModuleType)
-    args_len = len(allowed.args)
+    args_len = len(signature.positional_names)
+    minimum = signature.min_args
+    maximum = signature.max_args
     if is_method:
       args_len -= 1
-    minimum = args_len - (allowed.defaults and len(allowed.defaults) or 0)
-    maximum = None
-    if allowed.varargs is None and allowed.keywords is None:
-      maximum = args_len
-    total_positional = len(
-        kargs + tuple(a for a in kwargs if a in allowed.args))
-    named_optionals = [a for a in kwargs
-        if allowed.defaults
-        if a in allowed.args[len(allowed.args) - len(allowed.defaults):]]
-    if allowed.defaults and total_positional == minimum and named_optionals:
+      minimum -= 1
+      if maximum is not None:
+        maximum -= 1
+    named_positionals = [a for a in kwargs
+                         if a in signature.positional_name_set]
+    total_positional = len(kargs) + len(named_positionals)
+    named_optionals = [a for a in kwargs if a in signature.optional_names]
+    if total_positional == minimum and named_optionals:
       minimum += len(named_optionals)
     if total_positional < minimum:
       raise MethodSignatureError(
@@ -281,26 +1137,24 @@ class Expectation(object):
       raise MethodSignatureError(
           '%s requires at most %s arguments, expectation provided %s' %
           (self.name, maximum, total_positional))
-    if args_len == len(kargs) and any(a for a in kwargs if a in allowed.args):
+    if args_len == len(kargs) and named_positionals:
       raise MethodSignatureError(
           '%s already given as positional arguments to %s' %
-          ([a for a in kwargs if a in allowed.args], self.name))
-    if (not allowed.keywords and
-        any(a for a in kwargs if a not in allowed.args + allowed.kwonlyargs)):
-      raise MethodSignatureError(
-          '%s is not a valid keyword argument to %s' %
-          ([a for a in kwargs
-            if a not in (allowed.args + allowed.kwonlyargs)][0], self.name))
+          (named_positionals, self.name))
+    if not signature.accepts_any_kwargs:
+      invalid = [a for a in kwargs if a not in signature.allowed_kwargs]
+      if invalid:
+        raise MethodSignatureError(
+            '%s is not a valid keyword argument to %s' %
+            (invalid[0], self.name))
     # check that kwonlyargs that don't have default value specified are provided
-    required_kwonlyargs = [a for a in allowed.kwonlyargs
-                           if a not in (allowed.kwonlydefaults or {})]
-    missing_kwonlyargs = [a for a in required_kwonlyargs if a not in kwargs]
+    missing_kwonlyargs = [a for a in signature.required_kwonlyargs
+                          if a not in kwargs]
     if missing_kwonlyargs:
       raise MethodSignatureError(
           '%s requires keyword-only argument(s) "%s"' %
           (self.name, '", "'.join(missing_kwonlyargs)))
 
-
   def _update_original(self, name, obj):
     if hasattr(obj, '__dict__') and name in obj.__dict__:
       self.original = obj.__dict__[name]
@@ -309,33 +1163,33 @@ class Expectation(object):
     self._update_argspec()
 
   def _update_argspec(self):
-    original = self.__dict__.get('original')
+    original = self.original
     if original:
-      try:
-        if sys.version_info < (3, 0):
-          self.argspec = FullArgSpec(inspect.getargspec(original))
-        else:
-          self.argspec = FullArgSpec(inspect.getfullargspec(original))
-      except TypeError:
-        # built-in function: fall back to stupid processing and hope the
-        # builtins don't change signature
-        pass
+      signature = _get_signature(original)
+      if signature:
+        self._signature = signature
+        self.argspec = signature.argspec
 
   def _normalize_named_args(self, *kargs, **kwargs):
-    argspec = self.argspec
-    default = {'kargs': kargs, 'kwargs': kwargs}
-    if not argspec:
+    default = Arguments(kargs, kwargs)
+    if not self.argspec:
       return default
-    ret = {'kargs': (), 'kwargs': kwargs}
-    if inspect.ismethod(self.original):
-      args = argspec.args[1:]
-    else:
-      args = argspec.args
+    ret = Arguments((), dict(kwargs))
+    args = self._positional_names()
     for i, arg in enumerate(kargs):
       if len(args) <= i: return default
-      ret['kwargs'][args[i]] = arg
+      ret.kwargs[args[i]] = arg
     return ret
 
+  def _positional_names(self):
+    signature = self._signature
+    if not signature:
+      return None
+    if inspect.ismethod(self.original):
+      return signature.bound_positional_names
+    else:
+      return signature.positional_names
+
   def __raise(self, exception, message):
     """Safe internal raise implementation.
 
@@ -349,24 +1203,12 @@ class Expectation(object):
 
   def match_args(self, given_args):
     """Check if the set of given arguments matches this expectation."""
-    expected_args = self.args
-    given_args = self._normalize_named_args(
-        *given_args['kargs'], **given_args['kwargs'])
-    if (expected_args == given_args or expected_args is None):
+    matcher = self._matcher
+    if matcher is None:
       return True
-    if (len(given_args['kargs']) != len(expected_args['kargs']) or
-        len(given_args['kwargs']) != len(expected_args['kwargs']) or
-        (sorted(given_args['kwargs'].keys()) !=
-         sorted(expected_args['kwargs'].keys()))):
-      return False
-    for i, arg in enumerate(given_args['kargs']):
-      if not _arguments_match(arg, expected_args['kargs'][i]):
-        return False
-    for k, v in given_args['kwargs'].items():
-      if not _arguments_match(v, expected_args['kwargs'][k]):
-        return False
-    return True
+    return matcher.match(given_args.kargs, given_args.kwargs)
 
+  @property
   def mock(self):
     """Return the mock associated with this expectation."""
     return self._mock
@@ -383,14 +1225,18 @@ class Expectation(object):
     """
     if not self._callable:
       self.__raise(FlexmockError, "can't use with_args() with attribute stubs")
-    self._update_argspec()
+    if not self._signature:
+      self._update_argspec()
     if self.argspec:
       # do this outside try block as TypeError is way too general and catches
       # unrelated errors in the verify signature code
       self._verify_signature_match(*kargs, **kwargs)
       self.args = self._normalize_named_args(*kargs, **kwargs)
     else:
-      self.args = {'kargs': kargs, 'kwargs': kwargs}
+      self.args = Arguments(kargs, kwargs)
+    self._matcher = ArgumentsMatcher(self.args, self._positional_names())
+    if FlexmockContainer.compacted:
+      FlexmockContainer.restore_compacted(self)
     return self
 
   def and_return(self, *values):
@@ -422,15 +1268,13 @@ class Expectation(object):
       _setattr(self._mock, self.name, value)
       return self
 
-    return_values = _getattr(self, 'return_values')
-    if not _getattr(self, '_one_by_one'):
-      value = ReturnValue(value)
-      return_values.append(value)
+    if not self._one_by_one:
+      self._add_return_values(ReturnValue(value))
     else:
       try:
-        return_values.extend([ReturnValue(v) for v in value])
+        self._add_return_values(*[ReturnValue(v) for v in value])
       except TypeError:
-        return_values.append(ReturnValue(value))
+        self._add_return_values(ReturnValue(value))
     return self
 
   def times(self, number):
@@ -450,11 +1294,40 @@ class Expectation(object):
     """
     if not self._callable:
       self.__raise(FlexmockError, "can't use times() with attribute stubs")
-    expected_calls = _getattr(self, 'expected_calls')
-    modifier = _getattr(self, 'modifier')
+    expected_calls = self.expected_calls
+    modifier = self.modifier
     expected_calls[modifier] = number
+    self._update_call_limits()
     return self
 
+  @property
+  def once(self):
+    """Alias for times(1)."""
+    return self.times(1)
+
+  @property
+  def twice(self):
+    """Alias for times(2)."""
+    return self.times(2)
+
+  @property
+  def never(self):
+    """Alias for times(0)."""
+    return self.times(0)
+
+  def _update_call_limits(self):
+    """Precomputes the integer bounds checked by _verify_number_of_calls."""
+    expected_calls = self.expected_calls
+    if expected_calls[EXACTLY] is not None:
+      self._min_calls = self._max_calls = expected_calls[EXACTLY]
+    else:
+      self._min_calls = expected_calls[AT_LEAST] or 0
+      if expected_calls[AT_MOST] is not None:
+        self._max_calls = expected_calls[AT_MOST]
+      else:
+        self._max_calls = UNLIMITED_CALLS
+
+  @property
   def one_by_one(self):
     """Modifies the return value to be treated as a list of return values.
 
@@ -467,9 +1340,8 @@ class Expectation(object):
       self.__raise(FlexmockError, "can't use one_by_one() with attribute stubs")
     if not self._one_by_one:
       self._one_by_one = True
-      return_values = _getattr(self, 'return_values')
-      saved_values = return_values[:]
-      self.return_values = return_values = []
+      saved_values = self.return_values
+      self.return_values = return_values = ReturnValueQueue()
       for value in saved_values:
         try:
           for val in value.value:
@@ -478,6 +1350,7 @@ class Expectation(object):
           return_values.append(value)
     return self
 
+  @property
   def at_least(self):
     """Modifies the associated times() expectation.
 
@@ -489,8 +1362,8 @@ class Expectation(object):
     """
     if not self._callable:
       self.__raise(FlexmockError, "can't use at_least() with attribute stubs")
-    expected_calls = _getattr(self, 'expected_calls')
-    modifier = _getattr(self, 'modifier')
+    expected_calls = self.expected_calls
+    modifier = self.modifier
     if expected_calls[AT_LEAST] is not None or modifier == AT_LEAST:
       self.__raise(FlexmockError, 'cannot use at_least modifier twice')
     if modifier == AT_MOST and expected_calls[AT_MOST] is None:
@@ -498,6 +1371,7 @@ class Expectation(object):
     self.modifier = AT_LEAST
     return self
 
+  @property
   def at_most(self):
     """Modifies the associated "times" expectation.
 
@@ -509,8 +1383,8 @@ class Expectation(object):
     """
     if not self._callable:
       self.__raise(FlexmockError, "can't use at_most() with attribute stubs")
-    expected_calls = _getattr(self, 'expected_calls')
-    modifier = _getattr(self, 'modifier')
+    expected_calls = self.expected_calls
+    modifier = self.modifier
     if expected_calls[AT_MOST] is not None or modifier == AT_MOST:
       self.__raise(FlexmockError, 'cannot use at_most modifier twice')
     if modifier == AT_LEAST and expected_calls[AT_LEAST] is None:
@@ -518,6 +1392,7 @@ class Expectation(object):
     self.modifier = AT_MOST
     return self
 
+  @property
   def ordered(self):
     """Makes the expectation respect the order of should_receive statements.
 
@@ -530,7 +1405,9 @@ class Expectation(object):
     if not self._callable:
       self.__raise(FlexmockError, "can't use ordered() with attribute stubs")
     self._ordered = True
-    FlexmockContainer.ordered.append(self)
+    self._order_index = FlexmockContainer.add_ordered(self)
+    if FlexmockContainer.compacted:
+      FlexmockContainer.restore_compacted(self)
     return self
 
   def when(self, func):
@@ -562,9 +1439,8 @@ class Expectation(object):
     """
     if not self._callable:
       self.__raise(FlexmockError, "can't use and_raise() with attribute stubs")
-    args = {'kargs': kargs, 'kwargs': kwargs}
-    return_values = _getattr(self, 'return_values')
-    return_values.append(ReturnValue(raises=exception, value=args))
+    self._add_return_values(
+        ReturnValue(raises=exception, value=Arguments(kargs, kwargs)))
     return self
 
   def replace_with(self, function):
@@ -579,8 +1455,8 @@ class Expectation(object):
     if not self._callable:
       self.__raise(FlexmockError,
           "can't use replace_with() with attribute/property stubs")
-    replace_with = _getattr(self, '_replace_with')
-    original = self.__dict__.get('original')
+    replace_with = self._replace_with
+    original = self.original
     if replace_with:
       self.__raise(FlexmockError, 'replace_with cannot be specified twice')
     if function == original:
@@ -591,7 +1467,8 @@ class Expectation(object):
   def and_yield(self, *kargs):
     """Specifies the list of items to be yielded on successive method calls.
 
-    In effect, the mocked object becomes a generator.
+    In effect, the mocked object becomes a generator, or an async generator
+    when the original is an async generator function.
 
     Returns:
       - self, i.e. can be chained with other Expectation methods
@@ -599,6 +1476,8 @@ class Expectation(object):
     if not self._callable:
       self.__raise(
           FlexmockError, "can't use and_yield() with attribute stubs")
+    if _is_async_generator_function(self.original):
+      return self.and_return(_AsyncIterator(kargs))
     return self.and_return(iter(kargs))
 
   def verify(self, final=True):
@@ -611,59 +1490,39 @@ class Expectation(object):
     Raises:
       MethodCallError Exception
     """
-    failed, message = self._verify_number_of_calls(final)
-    if failed and not self._verified:
+    if self._verify_number_of_calls(final) and not self._verified:
       self._verified = True
       self.__raise(
           MethodCallError,
           '%s expected to be called %s times, called %s times' %
-          (_format_args(self.name, self.args), message, self.times_called))
+          (_format_args(self.name, self.args),
+           self._format_expected_calls(final), self.times_called))
 
   def _verify_number_of_calls(self, final):
-    failed = False
+    """Returns True if the number of calls made violates the expectation."""
+    times_called = self.times_called
+    if times_called > self._max_calls:
+      return True
+    return final and times_called < self._min_calls
+
+  def _format_expected_calls(self, final):
     message = ''
-    expected_calls = _getattr(self, 'expected_calls')
-    times_called = _getattr(self, 'times_called')
+    expected_calls = self.expected_calls
     if expected_calls[EXACTLY] is not None:
       message = 'exactly %s' % expected_calls[EXACTLY]
-      if final:
-        if times_called != expected_calls[EXACTLY]:
-          failed = True
-      else:
-        if times_called > expected_calls[EXACTLY]:
-          failed = True
     else:
       if final and expected_calls[AT_LEAST] is not None:
         message = 'at least %s' % expected_calls[AT_LEAST]
-        if times_called < expected_calls[AT_LEAST]:
-          failed = True
       if expected_calls[AT_MOST] is not None:
         if message:
           message += ' and '
         message += 'at most %s' % expected_calls[AT_MOST]
-        if times_called > expected_calls[AT_MOST]:
-          failed = True
-    return failed, message
+    return message
 
   def reset(self):
     """Returns the methods overriden by this expectation to their originals."""
-    _mock = _getattr(self, '_mock')
-    if not isinstance(_mock, Mock):
-      original = self.__dict__.get('original')
-      if original:
-        # name may be unicode but pypy demands dict keys to be str
-        name = str(_getattr(self, 'name'))
-        if (hasattr(_mock, '__dict__') and
-            name in _mock.__dict__ and
-            self._local_override):
-          del _mock.__dict__[name]
-        elif (hasattr(_mock, '__dict__') and
-            name in _mock.__dict__ and
-            type(_mock.__dict__) is dict):
-          _mock.__dict__[name] = original
-        else:
-          setattr(_mock, name, original)
-    del self
+    # name may be unicode but pypy demands dict keys to be str
+    FlexmockContainer.undo_change(self._mock, str(self.name))
 
 
 class Mock(object):
@@ -717,7 +1576,7 @@ class Mock(object):
     if name in UPDATED_ATTRS:
       raise FlexmockError('unable to replace flexmock methods')
     chained_methods = None
-    obj = _getattr(self, '_object')
+    obj = self._object
     if '.' in name:
       name, chained_methods = name.split('.', 1)
     name = _update_name_if_private(obj, name)
@@ -725,11 +1584,14 @@ class Mock(object):
     if chained_methods:
       if (not isinstance(obj, Mock) and
           not hasattr(getattr(obj, name), '__call__')):
-        return_value = _create_partial_mock(getattr(obj, name))
+        return_value = getattr(obj, name)
+        mock = _create_partial_mock(return_value)
+        if not FlexmockContainer.partial_mock_handles:
+          return_value = mock
       else:
-        return_value = Mock()
+        return_value = mock = Mock()
       self._create_expectation(obj, name, return_value)
-      return return_value.should_receive(chained_methods)
+      return mock.should_receive(chained_methods)
     else:
       return self._create_expectation(obj, name)
 
@@ -749,7 +1611,7 @@ class Mock(object):
       - Expectation object
     """
     expectation = self.should_receive(name)
-    return expectation.replace_with(expectation.__dict__.get('original'))
+    return expectation.replace_with(expectation.original)
 
   def new_instances(self, *kargs):
     """Overrides __new__ method on the class to return custom objects.
@@ -768,28 +1630,29 @@ class Mock(object):
       raise FlexmockError('new_instances can only be called on a class mock')
 
   def _create_expectation(self, obj, name, return_value=None):
-    if self not in FlexmockContainer.flexmock_objects:
-      FlexmockContainer.flexmock_objects[self] = []
+    FlexmockContainer.add_mock(self)
     expectation = self._save_expectation(name, return_value)
     FlexmockContainer.add_expectation(self, expectation)
     if _isproperty(obj, name):
       self._update_property(expectation, name, return_value)
-    elif (isinstance(obj, Mock) or
-          hasattr(getattr(obj, name), '__call__') or
-          _isclass(getattr(obj, name))):
+    elif isinstance(obj, Mock):
       self._update_method(expectation, name)
     else:
-      self._update_attribute(expectation, name, return_value)
+      attr = getattr(obj, name)
+      if hasattr(attr, '__call__') or _isclass(attr):
+        self._update_method(expectation, name)
+      else:
+        self._update_attribute(expectation, name, return_value)
     return expectation
 
   def _save_expectation(self, name, return_value=None):
-    if name in [x.name for x in
-                FlexmockContainer.flexmock_objects[self]]:
-      expectation = [x for x in FlexmockContainer.flexmock_objects[self]
-                     if x.name == name][0]
+    expectations = FlexmockContainer.expectations_by_name.get((self, name))
+    if expectations:
+      # every expectation for a name shares the original of the first one
+      expectation = expectations[0]
       expectation = Expectation(
           self._object, name=name, return_value=return_value,
-          original=expectation.__dict__.get('original'))
+          original=expectation.original)
     else:
       expectation = Expectation(
           self._object, name=name, return_value=return_value)
@@ -812,35 +1675,38 @@ class Mock(object):
         return self.__dict__[name](*kargs, **kwargs)
       else:
         return original(self, *kargs, **kwargs)
-    setattr(obj.__class__, name, updated)
-    if _get_code(updated) != _get_code(original):
-      self._create_placeholder_mock_for_proper_teardown(
-          obj.__class__, name, original)
-
-  def _create_placeholder_mock_for_proper_teardown(self, obj, name, original):
-    """Ensures that the given function is replaced on teardown."""
-    mock = Mock()
-    mock._object = obj
-    expectation = Expectation(obj, name=name, original=original)
-    FlexmockContainer.add_expectation(mock, expectation)
+    try:
+      if _get_code(original) is _get_code(updated):
+        return  # the class already dispatches to instances
+    except AttributeError:
+      pass
+    _setattr(obj.__class__, name, updated)
 
   def _update_method(self, expectation, name):
-    method_instance = self._create_mock_method(name)
     obj = self._object
-    if _hasattr(obj, name) and not hasattr(expectation, 'original'):
+    if _hasattr(obj, name) and expectation.original is None:
       expectation._update_original(name, obj)
-      method_type = type(_getattr(expectation, 'original'))
-      try:
-        # TODO(herman): this is awful, fix this properly.
-        # When a class/static method is mocked out on an *instance*
-        # we need to fetch the type from the class
-        method_type = type(_getattr(obj.__class__, name))
-      except: pass
+      method_type = type(expectation.original)
+      # When a class/static method is mocked out on an *instance*
+      # we need to fetch the type from the class
+      klass = _get_class(obj)
+      owner, attr = _get_class_attribute(klass, name)
+      if owner is klass:
+        method_type = type(attr)
       if method_type in SPECIAL_METHODS:
         expectation.original_function = getattr(obj, name)
       expectation.method_type = method_type
-    override = _setattr(obj, name, types.MethodType(method_instance, obj))
-    expectation._local_override = override
+    expectation._coroutine = _is_coroutine_function(expectation.original)
+    method = FlexmockContainer.mock_methods.get((self, name))
+    if method is None:
+      # every expectation for this method is dispatched by the same function
+      method = types.MethodType(self._create_mock_method(name), obj)
+      FlexmockContainer.mock_methods[(self, name)] = method
+    obj_dict = getattr(obj, '__dict__', None)
+    if obj_dict is not None and obj_dict.get(str(name)) is method:
+      override = False  # still in place from a previous expectation
+    else:
+      override = _setattr(obj, name, method)
     if (override and not _isclass(obj) and not isinstance(obj, Mock) and
         hasattr(obj.__class__, name)):
       self._update_class_for_magic_builtins(obj, name)
@@ -848,17 +1714,17 @@ class Mock(object):
   def _update_attribute(self, expectation, name, return_value=None):
     obj = self._object
     expectation._callable = False
-    if _hasattr(obj, name) and not hasattr(expectation, 'original'):
+    if _hasattr(obj, name) and expectation.original is None:
       expectation._update_original(name, obj)
-    override = _setattr(obj, name, return_value)
-    expectation._local_override = override
+    _setattr(obj, name, return_value)
 
   def _update_property(self, expectation, name, return_value=None):
-    new_name = '_flexmock__%s' % name
     obj = self._object
+    expectation._callable = False
     if not _isclass(obj):
+      if FlexmockContainer.instance_subclasses:
+        return  # the stubbed value overrides the property on the subclass
       obj = obj.__class__
-    expectation._callable = False
     original = getattr(obj, name)
     @property
     def updated(self):
@@ -866,120 +1732,157 @@ class Mock(object):
           name in self.__dict__):
         return self.__dict__[name]
       else:
-        return getattr(self, new_name)
-    setattr(obj, name, updated)
-    if not hasattr(obj, new_name):
-      # don't try to double update
-      FlexmockContainer.add_teardown_property(obj, new_name)
-      setattr(obj, new_name, original)
-      self._create_placeholder_mock_for_proper_teardown(obj, name, original)
+        return original.__get__(self, self.__class__)
+    try:
+      if _get_code(original.fget) is _get_code(updated.fget):
+        return  # don't try to double update
+    except AttributeError:
+      pass
+    _setattr(obj, name, updated)
 
   def _create_mock_method(self, name):
-    def _handle_exception_matching(expectation):
-      return_values = _getattr(expectation, 'return_values')
-      if return_values:
-        raised, instance = sys.exc_info()[:2]
-        message = '%s' % instance
-        expected = return_values[0].raises
-        if not expected:
-          raise
-        args = return_values[0].value
-        expected_instance = expected(*args['kargs'], **args['kwargs'])
-        expected_message = '%s' % expected_instance
-        if _isclass(expected):
-          if expected is not raised and expected not in raised.__bases__:
-            raise (ExceptionClassError('expected %s, raised %s' %
-                   (expected, raised)))
-          if args['kargs'] and type(RE_TYPE) is type(args['kargs'][0]):
-            if not args['kargs'][0].search(message):
-              raise (ExceptionMessageError('expected /%s/, raised "%s"' %
-                     (args['kargs'][0].pattern, message)))
-          elif expected_message and expected_message != message:
-            raise (ExceptionMessageError('expected "%s", raised "%s"' %
-                   (expected_message, message)))
-        elif expected is not raised:
-          raise (ExceptionClassError('expected "%s", raised "%s"' %
-                 (expected, raised)))
-      else:
-        raise
-
-    def match_return_values(expected, received):
-      if not isinstance(expected, tuple):
-        expected = (expected,)
-      if not isinstance(received, tuple):
-        received = (received,)
-      if len(received) != len(expected):
-        return False
-      for i, val in enumerate(received):
-        if not _arguments_match(val, expected[i]):
-          return False
-      return True
-
-    def pass_thru(expectation, runtime_self, *kargs, **kwargs):
-      return_values = None
-      try:
-        original = _getattr(expectation, 'original')
-        _mock = _getattr(expectation, '_mock')
-        if _isclass(_mock):
-          if type(original) in SPECIAL_METHODS:
-            original = _getattr(expectation, 'original_function')
-            return_values = original(*kargs, **kwargs)
-          else:
-            return_values = original(runtime_self, *kargs, **kwargs)
-        else:
-          return_values = original(*kargs, **kwargs)
-      except:
-        return _handle_exception_matching(expectation)
-      expected_values = _getattr(expectation, 'return_values')
-      if (expected_values and
-          not match_return_values(expected_values[0].value, return_values)):
-        raise (MethodSignatureError('expected to return %s, returned %s' %
-               (expected_values[0].value, return_values)))
-      return return_values
-
+    container = _container_state.get()
     def mock_method(runtime_self, *kargs, **kwargs):
-      arguments = {'kargs': kargs, 'kwargs': kwargs}
+      if _container_state.get() is not container:
+        # called from another thread or task, look in the mock's container
+        token = _container_state.set(container)
+        try:
+          return mock_method(runtime_self, *kargs, **kwargs)
+        finally:
+          _container_state.reset(token)
+      arguments = Arguments(kargs, kwargs)
       expectation = FlexmockContainer.get_flexmock_expectation(
           self, name, arguments)
       if expectation:
         if not expectation.runnable():
           raise StateError('%s expected to be called when %s is True' %
                              (name, expectation._get_runnable()))
-        expectation.times_called += 1
-        expectation.verify(final=False)
-        _pass_thru = _getattr(expectation, '_pass_thru')
-        _replace_with = _getattr(expectation, '_replace_with')
-        if _pass_thru:
-          return pass_thru(expectation, runtime_self, *kargs, **kwargs)
-        elif _replace_with:
-          return _replace_with(*kargs, **kwargs)
-        return_values = _getattr(expectation, 'return_values')
-        if return_values:
-          return_value = return_values[0]
-          del return_values[0]
-          return_values.append(return_value)
+        counter = expectation._call_counter
+        if counter is None:
+          expectation._times_called += 1
+          if expectation._times_called > expectation._max_calls:
+            expectation.verify(final=False)
         else:
-          return_value = ReturnValue()
+          counter.add()
+          if (expectation._max_calls != UNLIMITED_CALLS and
+              expectation.times_called > expectation._max_calls):
+            expectation.verify(final=False)
+        if expectation._pass_thru:
+          return _pass_thru(expectation, runtime_self, *kargs, **kwargs)
+        replace_with = expectation._replace_with
+        if replace_with:
+          return replace_with(*kargs, **kwargs)
+        return_values = expectation.return_values
+        if not return_values:
+          if expectation._coroutine:
+            return _ResolvedAwaitable()
+          return None
+        if counter is None:
+          return_value = return_values.next_value()
+        else:
+          return_value = counter.take_value(return_values)
         if return_value.raises:
           if _isclass(return_value.raises):
-            raise return_value.raises(
-                *return_value.value['kargs'], **return_value.value['kwargs'])
+            exception = return_value.raises(
+                *return_value.value.kargs, **return_value.value.kwargs)
           else:
-            raise return_value.raises
+            exception = return_value.raises
+          if expectation._coroutine:
+            # raised when awaited, as the real coroutine would
+            return _ResolvedAwaitable(exception=exception)
+          raise exception
+        elif expectation._coroutine:
+          return _ResolvedAwaitable(return_value.value)
         else:
           return return_value.value
       else:
         # make sure to clean up expectations to ensure none of them
         # interfere with the runner's error reporing mechanism
-        # e.g. open()
-        for _, expectations in FlexmockContainer.flexmock_objects.items():
-          for expectation in expectations:
-            _getattr(expectation, 'reset')()
+        # e.g. open(), the rest is left to teardown
+        if FlexmockContainer.full_reset_on_unmatched_call:
+          FlexmockContainer.undo_changes()
+        else:
+          FlexmockContainer.undo_module_changes()
         raise MethodSignatureError(_format_args(name, arguments))
 
     return mock_method
 
 
+def _handle_exception_matching(expectation):
+  return_values = expectation.return_values
+  if return_values:
+    raised, instance = sys.exc_info()[:2]
+    message = '%s' % instance
+    expected = return_values[0].raises
+    if not expected:
+      raise
+    args = return_values[0].value
+    expected_instance = expected(*args.kargs, **args.kwargs)
+    expected_message = '%s' % expected_instance
+    if _isclass(expected):
+      if expected is not raised and expected not in raised.__bases__:
+        raise (ExceptionClassError('expected %s, raised %s' %
+               (expected, raised)))
+      if args.kargs and type(RE_TYPE) is type(args.kargs[0]):
+        if not args.kargs[0].search(message):
+          raise (ExceptionMessageError('expected /%s/, raised "%s"' %
+                 (args.kargs[0].pattern, message)))
+      elif expected_message and expected_message != message:
+        raise (ExceptionMessageError('expected "%s", raised "%s"' %
+               (expected_message, message)))
+    elif expected is not raised:
+      raise (ExceptionClassError('expected "%s", raised "%s"' %
+             (expected, raised)))
+  else:
+    raise
+
+
+def _match_return_values(expected, received):
+  if not isinstance(expected, tuple):
+    expected = (expected,)
+  if not isinstance(received, tuple):
+    received = (received,)
+  if len(received) != len(expected):
+    return False
+  for i, val in enumerate(received):
+    if not _arguments_match(val, expected[i]):
+      return False
+  return True
+
+
+def _pass_thru(expectation, runtime_self, *kargs, **kwargs):
+  return_values = None
+  try:
+    original = expectation.original
+    _mock = expectation._mock
+    if _isclass(_mock):
+      if type(original) in SPECIAL_METHODS:
+        original = expectation.original_function
+        return_values = original(*kargs, **kwargs)
+      else:
+        return_values = original(runtime_self, *kargs, **kwargs)
+    else:
+      return_values = original(*kargs, **kwargs)
+  except:
+    return _handle_exception_matching(expectation)
+  if expectation._coroutine:
+    return _CheckedAwaitable(expectation, return_values)
+  return _check_return_value(expectation, return_values)
+
+
+def _check_return_value(expectation, return_value):
+  expected_values = expectation.return_values
+  if (expected_values and
+      not _match_return_values(expected_values[0].value, return_value)):
+    raise (MethodSignatureError('expected to return %s, returned %s' %
+           (expected_values[0].value, return_value)))
+  return return_value
+
+
+def _always_runnable():
+  return True
+
+
 def _arg_to_str(arg):
   if type(RE_TYPE) is type(arg):
     return '/%s/' % arg.pattern
@@ -1012,11 +1915,9 @@ def _format_args(name, arguments):
 
 
 def _create_partial_mock(obj_or_class, **kwargs):
-  matches = [x for x in FlexmockContainer.flexmock_objects
-             if x._object is obj_or_class]
-  if matches:
-    mock = matches[0]
-  else:
+  mock = FlexmockContainer.mocks_by_object.get(id(obj_or_class))
+  existing = mock is not None
+  if not existing:
     mock = Mock()
     mock._object = obj_or_class
   for name, return_value in kwargs.items():
@@ -1024,10 +1925,16 @@ def _create_partial_mock(obj_or_class, **kwargs):
       mock.should_receive(name).replace_with(return_value)
     else:
       mock.should_receive(name).and_return(return_value)
-  if not matches:
+  if not existing:
     FlexmockContainer.add_expectation(mock, Expectation(obj_or_class))
-  if (_attach_flexmock_methods(mock, Mock, obj_or_class) and
-    not _isclass(mock._object)):
+  if FlexmockContainer.partial_mock_handles:
+    return mock
+  if existing and (id(obj_or_class), UPDATED_ATTRS[0]) in (
+      FlexmockContainer.journaled):
+    attached = True  # flexmock methods are still in place from last time
+  else:
+    attached = _attach_flexmock_methods(mock, Mock, obj_or_class)
+  if attached and not _isclass(mock._object):
     mock = mock._object
   return mock
 
@@ -1063,6 +1970,29 @@ def _get_code(func):
   return getattr(func, code)
 
 
+def _compile_argument(expected_arg):
+  """Pairs an expected argument with the kind of check it needs."""
+  if _isclass(expected_arg):
+    return expected_arg, ArgumentsMatcher.CLASS
+  elif type(RE_TYPE) is type(expected_arg):
+    return expected_arg, ArgumentsMatcher.REGEX
+  else:
+    return expected_arg, ArgumentsMatcher.EQUAL
+
+
+def _argument_matches(arg, compiled):
+  """Same as _arguments_match() but for a pre-compiled expected argument."""
+  expected_arg, kind = compiled
+  if arg is expected_arg or expected_arg == arg:
+    return True
+  elif kind == ArgumentsMatcher.CLASS:
+    return isinstance(arg, expected_arg)
+  elif kind == ArgumentsMatcher.REGEX:
+    return bool(expected_arg.search(arg))
+  else:
+    return False
+
+
 def _arguments_match(arg, expected_arg):
   if expected_arg == arg:
     return True
@@ -1075,14 +2005,24 @@ def _arguments_match(arg, expected_arg):
     return False
 
 
-def _getattr(obj, name):
-  """Convenience wrapper to work around custom __getattribute__."""
-  return object.__getattribute__(obj, name)
-
-
 def _setattr(obj, name, value):
-  """Ensure we use local __dict__ where possible."""
+  """Ensure we use local __dict__ where possible.
+
+  Changes to anything but fake objects are journaled to be undone on teardown.
+  """
   name = str(name)  # name may be unicode but pypy demands dict keys to be str
+  if (FlexmockContainer.instance_subclasses and not isinstance(obj, Mock) and
+      not _isclass(obj) and not isinstance(obj, types.ModuleType)):
+    try:
+      _set_instance_attribute(obj, name, value)
+      return False
+    except TypeError:
+      # e.g. functions, their class can't be changed
+      if type(getattr(obj, '__dict__', None)) is not dict:
+        raise
+  state = None
+  if not isinstance(obj, Mock):
+    state = FlexmockContainer.capture_state(obj, name)
   local_override = False
   if hasattr(obj, '__dict__') and type(obj.__dict__) is dict:
     if name not in obj.__dict__:
@@ -1090,9 +2030,108 @@ def _setattr(obj, name, value):
     obj.__dict__[name] = value
   else:
     setattr(obj, name, value)
+  if state is not None:
+    FlexmockContainer.record_change(state)
   return local_override
 
 
+def _restore_attribute(obj, name, local, previous):
+  if name == '__class__':
+    obj.__class__ = previous
+    return
+  if FlexmockContainer.instance_overrides.pop(
+      (id(obj), name), _MISSING) is not _MISSING:
+    return
+  obj_dict = getattr(obj, '__dict__', None)
+  if type(obj_dict) is dict:
+    if local:
+      obj_dict[name] = previous
+    elif name in obj_dict:
+      del obj_dict[name]
+  elif local:
+    setattr(obj, name, previous)
+  else:
+    delattr(obj, name)
+
+
+class _InstanceAttribute(object):
+  """Serves an attribute stubbed on an instance moved to a generated subclass.
+
+  The subclass is shared by all instances of the class being mocked, those
+  without a stub for the attribute get it from the class or their __dict__.
+  """
+
+  def __init__(self, name):
+    self.name = name
+
+  def __get__(self, obj, owner):
+    name = self.name
+    if obj is None:
+      return getattr(owner.__bases__[0], name)
+    value = FlexmockContainer.instance_overrides.get((id(obj), name), _MISSING)
+    if value is not _MISSING:
+      return value
+    obj_dict = getattr(obj, '__dict__', None)
+    if obj_dict is not None and name in obj_dict:
+      return obj_dict[name]
+    return getattr(super(owner, obj), name)
+
+  def __set__(self, obj, value):
+    key = (id(obj), self.name)
+    if key in FlexmockContainer.instance_overrides:
+      FlexmockContainer.instance_overrides[key] = value
+    elif type(getattr(obj, '__dict__', None)) is dict:
+      obj.__dict__[self.name] = value
+    else:
+      getattr(type(obj).__bases__[0], self.name).__set__(obj, value)
+
+
+# class -> subclass its instances are moved to in order to be mocked
+_instance_subclasses = weakref.WeakValueDictionary()
+
+
+def _get_instance_subclass(obj):
+  """Moves obj to the generated subclass of its class, creating it if needed.
+
+  The change of class is journaled to be undone on teardown.
+  """
+  klass = obj.__class__
+  if klass.__bases__ and _instance_subclasses.get(klass.__bases__[0]) is klass:
+    return klass
+  subclass = _instance_subclasses.get(klass)
+  if subclass is None:
+    # no __slots__ would add a __dict__ and the instance couldn't be moved
+    subclass = type(klass.__name__, (klass,),
+                    {'__slots__': (), '__module__': klass.__module__})
+    if hasattr(klass, '__qualname__'):
+      subclass.__qualname__ = klass.__qualname__
+    _instance_subclasses[klass] = subclass
+  obj.__class__ = subclass
+  if (id(obj), '__class__') not in FlexmockContainer.journaled:
+    FlexmockContainer.record_change((obj, '__class__', True, klass))
+  return subclass
+
+
+def _set_instance_attribute(obj, name, value):
+  """Stubs an attribute of obj alone, leaving its class and __dict__ as is."""
+  subclass = _get_instance_subclass(obj)
+  if not isinstance(subclass.__dict__.get(name), _InstanceAttribute):
+    setattr(subclass, name, _InstanceAttribute(name))
+  key = (id(obj), name)
+  if key not in FlexmockContainer.journaled:
+    FlexmockContainer.record_change((obj, name, False, None))
+  FlexmockContainer.instance_overrides[key] = value
+
+
+def _get_class(obj):
+  """Returns the class of obj, looking through generated subclasses."""
+  klass = obj.__class__
+  if (_instance_subclasses and klass.__bases__ and
+      _instance_subclasses.get(klass.__bases__[0]) is klass):
+    return klass.__bases__[0]
+  return klass
+
+
 def _hasattr(obj, name):
   """Ensure hasattr checks don't create side-effects for properties."""
   if (not _isclass(obj) and hasattr(obj, '__dict__') and
@@ -1105,6 +2144,18 @@ def _hasattr(obj, name):
     return hasattr(obj, name)
 
 
+def _is_coroutine_function(func):
+  if type(func) in SPECIAL_METHODS:
+    func = func.__func__
+  return _iscoroutinefunction(func)
+
+
+def _is_async_generator_function(func):
+  if type(func) in SPECIAL_METHODS:
+    func = func.__func__
+  return _isasyncgenfunction(func)
+
+
 def _isclass(obj):
   """Fixes stupid bug in inspect.isclass from < 2.7."""
   if sys.version_info < (2, 7):
@@ -1113,18 +2164,32 @@ def _isclass(obj):
     return inspect.isclass(obj)
 
 
+def _get_class_attribute(klass, name):
+  """Finds where a class attribute is defined, without invoking descriptors.
+
+  Returns:
+    (defining class, raw attribute) tuple or (None, None) if not found
+  """
+  for base in inspect.getmro(klass):
+    base_dict = getattr(base, '__dict__', {})
+    if name in base_dict:
+      return base, base_dict[name]
+  return None, None
+
+
 def _isproperty(obj, name):
   if isinstance(obj, Mock):
     return False
   if not _isclass(obj) and hasattr(obj, '__dict__') and name not in obj.__dict__:
-    attr = getattr(obj.__class__, name)
-    if type(attr) is property:
-      return True
+    klass = _get_class(obj)
   elif _isclass(obj):
-    attr = getattr(obj, name)
-    if type(attr) is property:
-      return True
-  return False
+    klass = obj
+  else:
+    return False
+  owner, attr = _get_class_attribute(klass, name)
+  if owner is None:
+    attr = getattr(klass, name)
+  return type(attr) is property
 
 
 def _update_name_if_private(obj, name):
@@ -1147,40 +2212,26 @@ def _ensure_object_has_named_attribute(obj, name):
 
 
 def flexmock_teardown():
-  """Performs lexmock-specific teardown tasks."""
-  saved = {}
-  instances = []
-  classes = []
-  for mock_object, expectations in FlexmockContainer.flexmock_objects.items():
-    saved[mock_object] = expectations[:]
-    for expectation in expectations:
-      _getattr(expectation, 'reset')()
-  for mock in saved.keys():
-    obj = mock._object
-    if not isinstance(obj, Mock) and not _isclass(obj):
-      instances.append(obj)
-    if _isclass(obj):
-      classes.append(obj)
-  for obj in instances + classes:
-    for attr in UPDATED_ATTRS:
-      try:
-        obj_dict = obj.__dict__
-        if _get_code(obj_dict[attr]) is _get_code(Mock.__dict__[attr]):
-          del obj_dict[attr]
-      except:
-        try:
-          if _get_code(getattr(obj, attr)) is _get_code(Mock.__dict__[attr]):
-            delattr(obj, attr)
-        except AttributeError:
-          pass
-  FlexmockContainer.teardown_properties()
+  """Performs flexmock-specific teardown tasks.
+
+  Only what was done since the innermost open scope() is torn down.
+  """
+  if FlexmockContainer.scopes:
+    scope = FlexmockContainer.scopes[-1]
+    for expectation in FlexmockContainer.rollback(scope.teardown_savepoint):
+      expectation.verify()
+    return
+  saved = FlexmockContainer.flexmock_objects
+  if not saved and not FlexmockContainer.journal:
+    return
+  FlexmockContainer.undo_changes()
   FlexmockContainer.reset()
 
   # make sure this is done last to keep exceptions here from breaking
   # any of the previous steps that cleanup all the changes
-  for mock_object, expectations in saved.items():
+  for expectations in saved.values():
     for expectation in expectations:
-      _getattr(expectation, 'verify')()
+      expectation.verify()
 
 
 def flexmock(spec=None, **kwargs):
@@ -1209,48 +2260,187 @@ def flexmock(spec=None, **kwargs):
   """
   if spec is not None:
     return _create_partial_mock(spec, **kwargs)
-  else:
+  elif any(type(value) is property for value in kwargs.values()):
     # use this intermediate class to attach properties
     klass = type('MockClass', (Mock,), {})
     return klass(**kwargs)
+  else:
+    return Mock(**kwargs)
 
 
-# RUNNER INTEGRATION
+class Scope(object):
+  """Context manager and decorator returned by scope()."""
 
+  def __init__(self):
+    self.savepoint = None
+    self.teardown_savepoint = None
 
-def _hook_into_pytest():
-  try:
-    from _pytest import runner
-    saved = runner.call_runtest_hook
-    def call_runtest_hook(item, when, **kwargs):
-      ret = saved(item, when, **kwargs)
-      if when != 'call' and ret.excinfo is None:
-        return ret
-      teardown = runner.CallInfo(flexmock_teardown, when=when)
-      teardown.result = None
-      if ret.excinfo is not None and teardown.excinfo is None:
-          teardown.excinfo = ret.excinfo
-      return teardown
-    runner.call_runtest_hook = call_runtest_hook
-
-  except ImportError:
-    pass
-_hook_into_pytest()
+  def __enter__(self):
+    self.savepoint = FlexmockContainer.savepoint()
+    self.teardown_savepoint = self.savepoint
+    FlexmockContainer.scopes.append(self)
+    return self
 
+  def checkpoint(self):
+    """Keeps what was mocked in the scope so far until the scope is left.
 
-def _hook_into_doctest():
-  try:
-    from doctest import DocTestRunner
-    saved = DocTestRunner.run
-    def run(self, test, compileflags=None, out=None, clear_globs=True):
+    flexmock_teardown() then only undoes what is done after this call.
+    """
+    self.teardown_savepoint = FlexmockContainer.savepoint()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    scopes = FlexmockContainer.scopes
+    if self in scopes:
+      del scopes[scopes.index(self):]
+    expectations = FlexmockContainer.rollback(self.savepoint)
+    if exc_type is None:
+      for expectation in expectations:
+        expectation.verify()
+    return False
+
+  def __call__(self, func):
+    # keep the signature visible, e.g. for pytest to inject fixtures
+    @functools.wraps(func)
+    def decorated(*kargs, **kwargs):
+      with Scope():
+        return func(*kargs, **kwargs)
+    return decorated
+
+
+def scope():
+  """Limits teardown to what is mocked from here on.
+
+  Mocks and expectations set up inside the scope are torn down and verified
+  when it's left, while teardown after each test (flexmock_teardown) only
+  undoes what was done since the innermost open scope was entered, or since
+  its checkpoint() was called. This lets expensive mocks be set up once for
+  a whole test class or module.
+
+  Examples:
+    >>> with flexmock.scope() as scope:
+    ...   flexmock(SomeClass).should_receive('some_method')
+    ...   scope.checkpoint()
+    ...   run_tests()
+
+    >>> @flexmock.scope()
+    ... def test_something(): ...
+
+  Returns:
+    Scope object, usable as a context manager or a decorator
+  """
+  return Scope()
+# available as flexmock.scope() whichever way flexmock was imported
+flexmock.scope = scope
+
+
+def run_forked(func, *kargs, **kwargs):
+  """Calls func in a forked child process and returns its result.
+
+  The child inherits everything mocked so far and, before exiting, verifies
+  only the expectations added by func, so none of it has to be undone here.
+  Calls it makes to expectations set up here are added to their counts, to
+  be verified by this process. This lets a test suite mock its world once
+  and run each test, or batch of tests, in a child of its own.
+
+  Args:
+    - func: callable, its result must be picklable
+    - kargs, kwargs: arguments to call func with
+
+  Returns:
+    whatever func returned in the child
+
+  Raises:
+    the exception func or verification raised in the child, or
+    ForkedCallError when it can't be sent back or the child dies
+  """
+  import pickle
+  import traceback
+  inherited = [e for _, e in FlexmockContainer.added_expectations]
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if not pid:
+    try:
+      os.close(read_fd)
+      called = [e.times_called for e in inherited]
+      savepoint = FlexmockContainer.savepoint()
       try:
-        return saved(self, test, compileflags, out, clear_globs)
-      finally:
-        flexmock_teardown()
-    DocTestRunner.run = run
-  except ImportError:
-    pass
-_hook_into_doctest()
+        outcome = (True, func(*kargs, **kwargs), None)
+        for expectation in FlexmockContainer.rollback(savepoint):
+          expectation.verify()
+      except BaseException:
+        outcome = (False, sys.exc_info()[1], traceback.format_exc())
+      calls = [e.times_called - n for e, n in zip(inherited, called)]
+      try:
+        data = pickle.dumps(outcome + (calls,), pickle.HIGHEST_PROTOCOL)
+        pickle.loads(data)
+      except Exception:
+        formatted = outcome[2] or traceback.format_exc()
+        data = pickle.dumps((False, None, formatted, calls))
+      while data:
+        data = data[os.write(write_fd, data):]
+      sys.stdout.flush()
+      sys.stderr.flush()
+    finally:
+      os._exit(0)
+  os.close(write_fd)
+  chunks = []
+  chunk = os.read(read_fd, 65536)
+  while chunk:
+    chunks.append(chunk)
+    chunk = os.read(read_fd, 65536)
+  os.close(read_fd)
+  status = os.waitpid(pid, 0)[1]
+  if not chunks:
+    raise ForkedCallError('child process %d exited with status %d' %
+                          (pid, status))
+  succeeded, value, formatted, calls = pickle.loads(b''.join(chunks))
+  for expectation, n in zip(inherited, calls):
+    # shared memory counters have already seen the child's calls
+    if not isinstance(expectation._call_counter, _SharedCallCounter):
+      expectation._times_called += n
+  if succeeded:
+    return value
+  error = ForkedCallError('in child process %d:\n%s' % (pid, formatted))
+  if value is None:
+    raise error
+  value.__cause__ = error
+  raise value
+flexmock.run_forked = run_forked
+
+
+# RUNNER INTEGRATION
+
+
+def _hook_into_pytest(runner):
+  saved = runner.call_runtest_hook
+  def call_forked(item, **kwargs):
+    ret = saved(item, 'call', **kwargs)
+    if ret.excinfo is not None:
+      raise ret.excinfo.value
+  def call_runtest_hook(item, when, **kwargs):
+    if when == 'call' and FlexmockContainer.fork_per_test:
+      # the child verifies what the test mocked, the parent keeps its mocks
+      return runner.CallInfo(
+          lambda: run_forked(call_forked, item, **kwargs), when=when)
+    ret = saved(item, when, **kwargs)
+    if when != 'call' and ret.excinfo is None:
+      return ret
+    teardown = runner.CallInfo(flexmock_teardown, when=when)
+    teardown.result = None
+    if ret.excinfo is not None and teardown.excinfo is None:
+        teardown.excinfo = ret.excinfo
+    return teardown
+  runner.call_runtest_hook = call_runtest_hook
+
+
+def _hook_into_doctest(doctest):
+  saved = doctest.DocTestRunner.run
+  def run(self, test, compileflags=None, out=None, clear_globs=True):
+    try:
+      return saved(self, test, compileflags, out, clear_globs)
+    finally:
+      flexmock_teardown()
+  doctest.DocTestRunner.run = run
 
 
 def _patch_test_result(klass):
@@ -1300,8 +2490,7 @@ def _patch_test_result(klass):
     klass.addSuccess = addSuccess
 
 
-def _hook_into_unittest():
-  import unittest
+def _hook_into_unittest(unittest):
   try:
     try:
       # only valid TestResult class for unittest is TextTestResult
@@ -1311,68 +2500,128 @@ def _hook_into_unittest():
       _patch_test_result(unittest._TextTestResult)
   except: # let's not take any chances
     pass
-_hook_into_unittest()
 
 
-def _hook_into_unittest2():
+def _hook_into_unittest2(unittest2):
+  # also used for the copy of unittest2 Django falls back to
   try:
-    try:
-      from unittest2 import TextTestResult
-    except ImportError:
-      # Django has its own copy of unittest2 it uses as fallback
-      from django.utils.unittest import TextTestResult
-    _patch_test_result(TextTestResult)
+    _patch_test_result(unittest2.TextTestResult)
   except:
     pass
-_hook_into_unittest2()
 
 
-def _hook_into_twisted():
+def _hook_into_twisted(reporter):
   try:
-    from twisted.trial import reporter
     _patch_test_result(reporter.MinimalReporter)
     _patch_test_result(reporter.TextReporter)
     _patch_test_result(reporter.VerboseTextReporter)
     _patch_test_result(reporter.TreeReporter)
   except:
     pass
-_hook_into_twisted()
 
 
-def _hook_into_subunit():
+def _hook_into_subunit(subunit):
   try:
-    import subunit
     _patch_test_result(subunit.TestProtocolClient)
   except:
     pass
-_hook_into_subunit()
 
 
-def _hook_into_zope():
+def _hook_into_zope(runner):
   try:
-    from zope import testrunner
-    _patch_test_result(testrunner.runner.TestResult)
+    _patch_test_result(runner.TestResult)
   except:
     pass
-_hook_into_zope()
 
 
-def _hook_into_testtools():
+def _hook_into_testtools(testresult):
   try:
-    from testtools import testresult
     _patch_test_result(testresult.TestResult)
   except:
     pass
-_hook_into_testtools()
 
 
-def _hook_into_teamcity_unittest():
+def _hook_into_teamcity_unittest(tcunittest):
   try:
-    from tcunittest import TeamcityTestResult
-    _patch_test_result(TeamcityTestResult)
+    _patch_test_result(tcunittest.TeamcityTestResult)
   except:
     pass
-_hook_into_teamcity_unittest()
+
+
+class _RunnerHookFinder(object):
+  """Import hook installing runner integration once a runner is imported.
+
+  Runners that have already been imported when flexmock is are hooked into
+  right away, the rest only when (and if) their module gets imported, so
+  importing flexmock never imports any test runner itself.
+  """
+
+  def __init__(self, hooks):
+    self.hooks = hooks
+    self.importing = set()
+
+  def run_hook(self, name, module):
+    hook = self.hooks.pop(name, None)
+    if not self.hooks and self in sys.meta_path:
+      sys.meta_path.remove(self)
+    if hook is not None:
+      hook(module)
+
+  def find_spec(self, fullname, path=None, target=None):
+    """Python 3.4+ import hook."""
+    if fullname not in self.hooks or fullname in self.importing:
+      return None
+    import importlib.util
+    self.importing.add(fullname)
+    try:
+      spec = importlib.util.find_spec(fullname)
+    finally:
+      self.importing.discard(fullname)
+    if spec is None or not hasattr(spec.loader, 'exec_module'):
+      return None
+    exec_module = spec.loader.exec_module
+    def exec_and_hook(module):
+      exec_module(module)
+      self.run_hook(fullname, module)
+    spec.loader.exec_module = exec_and_hook
+    return spec
+
+  def find_module(self, fullname, path=None):
+    """Python 2 import hook."""
+    if fullname not in self.hooks or fullname in self.importing:
+      return None
+    return self
+
+  def load_module(self, fullname):
+    self.importing.add(fullname)
+    try:
+      __import__(fullname)
+    finally:
+      self.importing.discard(fullname)
+    module = sys.modules[fullname]
+    self.run_hook(fullname, module)
+    return module
+
+
+def _hook_into_runners():
+  finder = _RunnerHookFinder({
+      '_pytest.runner': _hook_into_pytest,
+      'doctest': _hook_into_doctest,
+      'unittest': _hook_into_unittest,
+      'unittest2': _hook_into_unittest2,
+      'django.utils.unittest': _hook_into_unittest2,
+      'twisted.trial.reporter': _hook_into_twisted,
+      'subunit': _hook_into_subunit,
+      'zope.testrunner.runner': _hook_into_zope,
+      'testtools.testresult': _hook_into_testtools,
+      'tcunittest': _hook_into_teamcity_unittest,
+  })
+  for name in list(finder.hooks):
+    if sys.modules.get(name) is not None:
+      finder.run_hook(name, sys.modules[name])
+  if finder.hooks:
+    sys.meta_path.insert(0, finder)
+_hook_into_runners()
 
 # Dark magic to make the flexmock module itself callable.
 # So that you can say:
@@ -1380,8 +2629,14 @@ _hook_into_teamcity_unittest()
 # instead of:
 #   from flexmock import flexmock
 class _CallableModule(types.ModuleType):
+  def __call__(self, *args, **kw):
+    return flexmock(*args, **kw)
+
+
+class _ForwardingModule(_CallableModule):
+  """Stands in for the module where its class can't be changed (< 3.5)."""
   def __init__(self):
-    super(_CallableModule, self).__init__('flexmock')
+    super(_ForwardingModule, self).__init__('flexmock')
     self._realmod = sys.modules['flexmock']
     sys.modules['flexmock'] = self
     self.__doc__ = flexmock.__doc__
@@ -1392,4 +2647,9 @@ class _CallableModule(types.ModuleType):
   def __getattr__(self, attr):
     return getattr(self._realmod, attr)
 
-_CallableModule()
+try:
+  # attribute access then needs no forwarding
+  sys.modules['flexmock'].__class__ = _CallableModule
+  __doc__ = flexmock.__doc__
+except TypeError:
+  _ForwardingModule()
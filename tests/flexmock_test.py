@@ -13,13 +13,19 @@ from flexmock import ExceptionMessageError
 from flexmock import StateError
 from flexmock import MethodCallError
 from flexmock import CallOrderError
+from flexmock import ForkedCallError
 from flexmock import ReturnValue
 from flexmock import flexmock_teardown
 from flexmock import _format_args
 from flexmock import _isproperty
 import flexmock
+import os
 import re
+import shutil
 import sys
+import tempfile
+import threading
+import types
 import unittest
 
 
@@ -127,6 +133,39 @@ class RegularClass(object):
     assert (FlexmockContainer.get_flexmock_expectation(
        mock, 'method_bar') is None)
 
+  def test_flexmock_expectations_are_indexed_by_name(self):
+    mock = flexmock(name='temp')
+    foo1 = mock.should_receive('method_foo')
+    mock.should_receive('method_bar')
+    foo2 = mock.should_receive('method_foo')
+    assertEqual([foo1, foo2],
+                FlexmockContainer.expectations_by_name[(mock, 'method_foo')])
+    assert (FlexmockContainer.get_flexmock_expectation(
+        mock, 'method_foo') is foo2)
+    self._tear_down()
+    assertEqual({}, FlexmockContainer.expectations_by_name)
+
+  def test_flexmock_compacts_shadowed_expectations(self):
+    mock = flexmock(name='temp')
+    foo1 = mock.should_receive('method_foo').with_args(1).once()
+    foo2 = mock.should_receive('method_foo').and_return(2)
+    foo3 = mock.should_receive('method_foo').and_return(3)
+    assertEqual([foo2, foo3],
+                FlexmockContainer.expectations_by_name[(mock, 'method_foo')])
+    assertEqual(3, mock.method_foo(1))
+    # shadowed expectations are still verified
+    assertRaises(MethodCallError, self._tear_down)
+
+  def test_flexmock_restores_compacted_expectations_on_with_args(self):
+    mock = flexmock(name='temp')
+    mock.should_receive('method_foo').and_return(1)
+    foo2 = mock.should_receive('method_foo').and_return(2)
+    mock.should_receive('method_foo').with_args('baz').and_return(3)
+    foo2.with_args('bar')
+    assertEqual(1, mock.method_foo('foo'))
+    assertEqual(2, mock.method_foo('bar'))
+    assertEqual(3, mock.method_foo('baz'))
+
   def test_flexmock_should_check_parameters(self):
     mock = flexmock(name='temp')
     mock.should_receive('method_foo').with_args('bar').and_return(1)
@@ -451,6 +490,22 @@ class RegularClass(object):
     mock.should_receive('method_foo').and_return('value_bar').never
     assertRaises(MethodCallError, mock.method_foo)
 
+  def test_flexmock_precomputes_call_limits(self):
+    mock = flexmock(name='temp')
+    exactly = mock.should_receive('method_foo').twice()
+    at_least = mock.should_receive('method_bar').at_least().once()
+    between = mock.should_receive('method_baz').at_least().once().at_most().twice()
+    assertEqual((2, 2), (exactly._min_calls, exactly._max_calls))
+    assertEqual((1, flexmock.UNLIMITED_CALLS),
+                (at_least._min_calls, at_least._max_calls))
+    assertEqual((1, 2), (between._min_calls, between._max_calls))
+    mock.method_foo()
+    mock.method_foo()
+    mock.method_bar()
+    mock.method_baz()
+    mock.method_baz()
+    assertRaises(MethodCallError, mock.method_baz)
+
   def test_flexmock_get_flexmock_expectation_should_work_with_args(self):
     mock = flexmock(name='temp')
     mock.should_receive('method_foo').with_args('value_bar')
@@ -636,6 +691,69 @@ class RegularClass(object):
     assertEqual(1, foo.method1())
     assertRaises(Exception, foo.method1)
 
+  def test_flexmock_should_count_consumed_return_values(self):
+    mock = flexmock()
+    expectation = mock.should_receive('method_foo').and_return(
+        1, 2, 3).one_by_one()
+    assertEqual(0, expectation.return_values.consumed)
+    assertEqual([1, 2, 3, 1], [mock.method_foo() for _ in range(4)])
+    assertEqual(4, expectation.return_values.consumed)
+    expectation.and_return(4)
+    assertEqual([2, 3, 1, 4], [mock.method_foo() for _ in range(4)])
+
+  def test_expectations_and_return_values_have_no_instance_dict(self):
+    mock = flexmock()
+    bare = mock.should_receive('method_foo')
+    assertEqual((), bare.return_values)
+    assertEqual(None, bare._expected_calls)
+    expectation = mock.should_receive('method_bar').with_args(1).and_raise(
+        Exception, 'foo').once()
+    assertEqual(False, hasattr(expectation, '__dict__'))
+    assertEqual(False, hasattr(expectation.return_values[0], '__dict__'))
+    assertEqual(False, hasattr(expectation.args, '__dict__'))
+    assertEqual((1,), expectation.args['kargs'])
+    assertEqual(True, expectation.args == {'kargs': (1,), 'kwargs': {}})
+    assertEqual(True, {'kargs': ('foo',), 'kwargs': {}} ==
+                      expectation.return_values[0].value)
+    assertEqual(True, flexmock.Arguments((1,), {}) == expectation.args)
+    assertEqual(False, flexmock.Arguments((1,), {}) != expectation.args)
+    assertEqual(True, flexmock.Arguments((2,), {}) != expectation.args)
+    assertRaises(Exception, mock.method_bar, 1)
+
+  def test_flexmock_should_reuse_mock_method_for_same_name(self):
+    class Foo(object):
+      def method1(self, a=None): pass
+    foo = Foo()
+    flexmock(foo).should_receive('method1').and_return(1)
+    method = foo.__dict__['method1']
+    flexmock(foo).should_receive('method1').with_args(2).and_return(2)
+    assert foo.__dict__['method1'] is method
+    assertEqual((1, 2), (foo.method1(), foo.method1(2)))
+    self._tear_down()
+    assertEqual(False, 'method1' in foo.__dict__)
+    assertEqual({}, FlexmockContainer.mock_methods)
+
+  def test_teardown_undoes_journaled_changes_in_reverse(self):
+    class Foo(object):
+      attr = 'attr'
+      def method1(self): return 'method1'
+      def __len__(self): return 1
+    foo = Foo()
+    saved_len = Foo.__dict__['__len__']
+    flexmock(foo).should_receive('method1').and_return(1)
+    flexmock(foo).should_receive('__len__').and_return(2)
+    flexmock(Foo).should_receive('attr').and_return('mocked')
+    flexmock(Foo).should_receive('attr').and_return('mocked again')
+    assertEqual((1, 2, 'mocked again'), (foo.method1(), len(foo), Foo.attr))
+    assert len(FlexmockContainer.journal) > 0
+    self._tear_down()
+    assertEqual([], FlexmockContainer.journal)
+    assertEqual(('method1', 1, 'attr'), (foo.method1(), len(foo), Foo.attr))
+    assert Foo.__dict__['__len__'] is saved_len
+    for attr in UPDATED_ATTRS:
+      assert attr not in foo.__dict__
+      assert attr not in Foo.__dict__
+
   def test_flexmock_should_match_types_on_multiple_arguments(self):
     class Foo:
       def method1(self, a, b): pass
@@ -899,6 +1017,330 @@ class RegularClass(object):
     self._tear_down()
     assertEqual('1, 2', module_level_function(1, 2))
 
+  def test_unmatched_call_only_restores_modules_by_default(self):
+    if 'flexmock_test' in sys.modules:
+      mod = sys.modules['flexmock_test']
+    else:
+      mod = sys.modules['__main__']
+    class Foo(object):
+      def method1(self, x): return 'method1'
+    foo = Foo()
+    flexmock(mod).should_receive('module_level_function').and_return(None)
+    flexmock(foo).should_receive('method1').with_args(1).and_return('mocked')
+    assertRaises(MethodSignatureError, foo.method1, 2)
+    assertEqual('1, 2', module_level_function(1, 2))
+    assertEqual('mocked', foo.method1(1))
+    self._tear_down()
+    assertEqual('method1', foo.method1(1))
+
+  def test_unmatched_call_restores_everything_with_full_reset(self):
+    class Foo(object):
+      def method1(self, x): return 'method1'
+    foo = Foo()
+    flexmock(foo).should_receive('method1').with_args(1).and_return('mocked')
+    FlexmockContainer.full_reset_on_unmatched_call = True
+    try:
+      assertRaises(MethodSignatureError, foo.method1, 2)
+    finally:
+      FlexmockContainer.full_reset_on_unmatched_call = False
+    assertEqual('method1', foo.method1(1))
+
+  def test_partial_mock_handles_leave_object_and_class_alone(self):
+    class Foo(object):
+      def method1(self): return 'method1'
+      def __len__(self): return 1
+    foo = Foo()
+    class_attrs = dict(Foo.__dict__)
+    FlexmockContainer.partial_mock_handles = True
+    try:
+      handle = flexmock(foo)
+      assert handle is not foo
+      assert handle is flexmock(foo)
+      handle.should_receive('method1').and_return('mocked').once()
+      assertEqual(False, hasattr(foo, 'should_receive'))
+      assertEqual('mocked', foo.method1())
+      assertEqual(class_attrs, dict(Foo.__dict__))
+      handle.should_receive('__len__').and_return(2)
+      assertEqual(2, len(foo))
+      assertEqual(1, len(Foo()))
+    finally:
+      FlexmockContainer.partial_mock_handles = False
+    self._tear_down()
+    assertEqual('method1', foo.method1())
+    assertEqual(1, len(foo))
+
+  def test_instance_subclasses_mock_single_slotted_instance(self):
+    class Foo(object):
+      __slots__ = ('x',)
+      def __init__(self): self.x = 1
+      def method1(self): return 'method1'
+      def __len__(self): return 1
+    foo = Foo()
+    foo2 = Foo()
+    class_attrs = dict(Foo.__dict__)
+    FlexmockContainer.instance_subclasses = True
+    try:
+      flexmock(foo).should_receive('method1').and_return('mocked').once()
+      foo.should_receive('__len__').and_return(2)
+      foo.should_receive('x').and_return(3)
+    finally:
+      FlexmockContainer.instance_subclasses = False
+    assertEqual(('mocked', 2, 3), (foo.method1(), len(foo), foo.x))
+    assertEqual(('method1', 1, 1), (foo2.method1(), len(foo2), foo2.x))
+    assert isinstance(foo, Foo) and type(foo) is not Foo
+    assertEqual(class_attrs, dict(Foo.__dict__))
+    self._tear_down()
+    assert type(foo) is Foo
+    assertEqual(('method1', 1, 1), (foo.method1(), len(foo), foo.x))
+
+  def test_instance_subclasses_are_shared_by_instances(self):
+    class Foo(object):
+      def __init__(self): self.attr = 'attr'
+    foo = Foo()
+    foo2 = Foo()
+    FlexmockContainer.instance_subclasses = True
+    try:
+      flexmock(foo).should_receive('attr').and_return('mocked')
+      flexmock(foo2)
+    finally:
+      FlexmockContainer.instance_subclasses = False
+    assert type(foo) is type(foo2)
+    assertEqual(('mocked', 'attr'), (foo.attr, foo2.attr))
+    foo2.attr = 'changed'
+    assertEqual('changed', foo2.__dict__['attr'])
+    self._tear_down()
+    assertEqual(('attr', 'changed'), (foo.attr, foo2.attr))
+
+  def test_scope_rolls_back_only_its_own_changes(self):
+    class Foo(object):
+      def method1(self): return 'method1'
+      def method2(self): return 'method2'
+    foo = Foo()
+    flexmock(foo).should_receive('method1').and_return('outer')
+    with flexmock.scope():
+      foo.should_receive('method1').and_return('inner')
+      foo.should_receive('method2').and_return('inner').once()
+      assertEqual(('inner', 'inner'), (foo.method1(), foo.method2()))
+    assertEqual(('outer', 'method2'), (foo.method1(), foo.method2()))
+    assertEqual([], FlexmockContainer.scopes)
+    self._tear_down()
+    assertEqual('method1', foo.method1())
+
+  def test_scope_restores_expectations_compacted_by_its_catch_alls(self):
+    mock = flexmock()
+    mock.should_receive('method_foo').with_args(1).and_return('one')
+    mock.should_receive('method_foo').and_return('any')
+    mock.should_receive('method_foo').and_return('any')
+    with flexmock.scope():
+      mock.should_receive('method_foo').and_return('inner')
+      mock.should_receive('method_foo').and_return('inner')
+      assertEqual('inner', mock.method_foo(1))
+    assertEqual('any', mock.method_foo(1))
+    mock.should_receive('method_foo').with_args(2).and_return('two')
+    assertEqual(('two', 'any'), (mock.method_foo(2), mock.method_foo(3)))
+    self._tear_down()
+
+  def test_scope_keeps_calls_to_ordered_expectations_from_outside(self):
+    mock = flexmock()
+    mock.should_receive('method_foo').ordered()
+    mock.should_receive('method_bar').ordered()
+    with flexmock.scope():
+      mock.should_receive('method_baz').ordered()
+      mock.method_foo()
+    mock.method_bar()
+    self._tear_down()
+
+  def test_teardown_inside_scope_keeps_scope_changes(self):
+    class Foo(object):
+      def method1(self): return 'method1'
+      def method2(self): return 'method2'
+    foo = Foo()
+    scope = flexmock.scope()
+    scope.__enter__()
+    try:
+      flexmock(foo).should_receive('method1').and_return('scope').twice()
+      scope.checkpoint()
+      for i in range(2):
+        foo.should_receive('method2').and_return('test').once()
+        assertEqual(('scope', 'test'), (foo.method1(), foo.method2()))
+        self._tear_down()
+        assertEqual('method2', foo.method2())
+    finally:
+      scope.__exit__(None, None, None)
+    assertEqual('method1', foo.method1())
+
+  def test_scope_decorator_verifies_expectations(self):
+    class Foo(object):
+      def method1(self): return 'method1'
+    @flexmock.scope()
+    def test_method():
+      flexmock(Foo).should_receive('method1').once()
+    assertRaises(MethodCallError, test_method)
+    assertEqual('method1', Foo().method1())
+    def test_fixtures(fixture1, fixture2=None): pass
+    decorated = flexmock.scope()(test_fixtures)
+    assertEqual('test_fixtures', decorated.__name__)
+    if sys.version_info >= (3, 2):
+      assertEqual(test_fixtures, decorated.__wrapped__)
+
+  def test_bound_containers_are_isolated(self):
+    class Foo(object):
+      def method1(self): return 'method1'
+    foo = Foo()
+    flexmock(foo).should_receive('method1').and_return('outer')
+    token = FlexmockContainer.bind()
+    try:
+      assertEqual({}, FlexmockContainer.flexmock_objects)
+      foo2 = Foo()
+      flexmock(foo2).should_receive('method1').and_return('inner').once()
+      results = []
+      thread = threading.Thread(target=lambda: results.append(foo2.method1()))
+      thread.start()
+      thread.join()
+      assertEqual(['inner'], results)
+      self._tear_down()
+      assertEqual('method1', foo2.method1())
+      assertEqual('outer', foo.method1())
+    finally:
+      FlexmockContainer.unbind(token)
+    self._tear_down()
+    assertEqual('method1', foo.method1())
+
+  def test_thread_safe_calls_count_calls_from_all_threads(self):
+    mock = flexmock()
+    FlexmockContainer.thread_safe_calls = True
+    try:
+      expectation = (mock.should_receive('method_foo')
+                     .and_return(1).and_return(2).times(40))
+    finally:
+      FlexmockContainer.thread_safe_calls = False
+    results = []
+    def call():
+      for i in range(10):
+        results.append(mock.method_foo())
+    threads = [threading.Thread(target=call) for i in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    assertEqual(40, expectation.times_called)
+    assertEqual(40, expectation.return_values.consumed)
+    assertEqual([1] * 20 + [2] * 20, sorted(results))
+    self._tear_down()
+
+  def test_shared_memory_calls_count_calls_from_forked_processes(self):
+    if sys.version_info < (3, 8) or not hasattr(os, 'fork'):
+      return
+    import multiprocessing
+    mock = flexmock()
+    FlexmockContainer.shared_memory_calls = True
+    try:
+      expectation = (mock.should_receive('method_foo')
+                     .and_return(1).and_return(2).times(6))
+    finally:
+      FlexmockContainer.shared_memory_calls = False
+    assertEqual(1, mock.method_foo())
+    def call():
+      for i in range(2):
+        mock.method_foo()
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=call) for i in range(2)]
+    for process in processes:
+      process.start()
+    for process in processes:
+      process.join()
+    assertEqual(5, expectation.times_called)
+    assertEqual(2, mock.method_foo())
+    self._tear_down()
+
+  def test_run_forked_inherits_mocks_and_discards_its_own(self):
+    if not hasattr(os, 'fork'):
+      return
+    class User(object):
+      def get_name(self):
+        return 'mike'
+      def get_age(self):
+        return 20
+    user = User()
+    flexmock(user).should_receive('get_name').and_return('john')
+    def test():
+      flexmock(user).should_receive('get_age').and_return(42)
+      return user.get_name(), user.get_age()
+    assertEqual(('john', 42), flexmock.run_forked(test))
+    assertEqual(20, user.get_age())
+    assertEqual('john', user.get_name())
+    self._tear_down()
+
+  def test_run_forked_raises_verification_failures_of_child(self):
+    if not hasattr(os, 'fork'):
+      return
+    mock = flexmock()
+    def test():
+      mock.should_receive('method_foo').once()
+    assertRaises(MethodCallError, flexmock.run_forked, test)
+    def unpicklable():
+      raise FlexmockError(lambda: None)
+    assertRaises(ForkedCallError, flexmock.run_forked, unpicklable)
+    self._tear_down()
+
+  def test_run_forked_leaves_expectations_of_parent_alone(self):
+    if not hasattr(os, 'fork'):
+      return
+    mock = flexmock()
+    mock.should_receive('method_foo').once()
+    mock.should_receive('method_bar').and_return('bar')
+    assertEqual('bar', flexmock.run_forked(mock.method_bar))
+    assertRaises(MethodCallError, self._tear_down)
+
+  def test_run_forked_counts_child_calls_to_expectations_of_parent(self):
+    if not hasattr(os, 'fork'):
+      return
+    mock = flexmock()
+    expectation = mock.should_receive('method_foo').and_return('foo').twice()
+    assertEqual('foo', flexmock.run_forked(mock.method_foo))
+    def failing():
+      mock.method_foo()
+      raise KeyError('failed')
+    assertRaises(KeyError, flexmock.run_forked, failing)
+    assertEqual(2, expectation.times_called)
+    self._tear_down()
+
+  def test_fork_per_test_runs_pytest_call_phase_in_child(self):
+    if not hasattr(os, 'fork'):
+      return
+    class ExceptionInfo(object):
+      def __init__(self, value):
+        self.value = value
+    class CallInfo(object):
+      def __init__(self, func, when):
+        self.when = when
+        self.result = self.excinfo = None
+        try:
+          self.result = func()
+        except Exception:
+          self.excinfo = ExceptionInfo(sys.exc_info()[1])
+    runner = types.ModuleType('runner')
+    runner.CallInfo = CallInfo
+    runner.call_runtest_hook = lambda item, when: CallInfo(item, when)
+    flexmock._hook_into_pytest(runner)
+    mock = flexmock()
+    expectation = mock.should_receive('method_foo').and_return(
+        'parent').once()
+    def passing():
+      assertEqual('parent', mock.method_foo())
+      mock.should_receive('method_foo').and_return('child')
+    def failing():
+      mock.should_receive('method_bar').once()
+    FlexmockContainer.fork_per_test = True
+    try:
+      assertEqual(None, runner.call_runtest_hook(passing, 'call').excinfo)
+      info = runner.call_runtest_hook(failing, 'call')
+    finally:
+      FlexmockContainer.fork_per_test = False
+    assertEqual(MethodCallError, type(info.excinfo.value))
+    assertEqual(1, expectation.times_called)
+    self._tear_down()
+
   def test_module_level_function_with_kwargs(self):
     if 'flexmock_test' in sys.modules:
       mod = sys.modules['flexmock_test']
@@ -1232,6 +1674,21 @@ class RegularClass(object):
     b = flexmock(foo)
     assertEqual(a, b)
 
+  def test_flexmock_indexes_partial_mocks_by_object(self):
+    class Foo(object):
+      bar = 0
+    foo = Foo()
+    flexmock(foo)
+    mock = FlexmockContainer.mocks_by_object[id(foo)]
+    assert mock._object is foo
+    flexmock(foo, bar=1)
+    assertEqual(1, foo.bar)
+    assert FlexmockContainer.mocks_by_object[id(foo)] is mock
+    assertEqual(1, len([m for m in FlexmockContainer.flexmock_objects
+                        if m._object is foo]))
+    self._tear_down()
+    assertEqual({}, FlexmockContainer.mocks_by_object)
+
   def test_flexmock_ordered_worked_after_default_stub(self):
     foo = flexmock()
     foo.should_receive('bar')
@@ -1260,6 +1717,18 @@ class RegularClass(object):
     c = foo.bar()
     assertEqual(c, 9)
 
+  def test_flexmock_ordered_tracks_position_in_call_order(self):
+    foo = flexmock()
+    for i in range(100):
+      foo.should_receive('bar').with_args(i).ordered().and_return(i)
+    assertEqual(0, FlexmockContainer.next_ordered)
+    assertEqual(list(range(50)), [foo.bar(i) for i in range(50)])
+    assertEqual(50, FlexmockContainer.next_ordered)
+    assertRaises(CallOrderError, foo.bar, 99)
+    self._tear_down()
+    assertEqual(([], 0), (FlexmockContainer.ordered,
+                          FlexmockContainer.next_ordered))
+
   def test_state_machine(self):
     class Radio:
       def __init__(self): self.is_on = False
@@ -1392,6 +1861,12 @@ class RegularClass(object):
     assertEqual('baz', foo.bar)
     assertEqual('baz', bar.foo)
 
+  def test_fake_object_only_gets_own_class_for_properties(self):
+    foo = flexmock(bar=property(lambda self: 'baz'))
+    assert type(foo) is not Mock
+    assert not hasattr(Mock, 'bar')
+    assert type(flexmock(bar='baz')) is Mock
+
   def test_replace_non_callable_class_attributes(self):
     class Foo:
       bar = 1
@@ -1451,10 +1926,22 @@ class RegularClass(object):
     assertRaises(FlexmockError, e.and_raise, Exception)
     assertRaises(FlexmockError, e.when, lambda x: x)
     assertRaises(FlexmockError, e.and_yield, 1)
-    assertRaises(FlexmockError, object.__getattribute__(e, 'ordered'))
-    assertRaises(FlexmockError, object.__getattribute__(e, 'at_least'))
-    assertRaises(FlexmockError, object.__getattribute__(e, 'at_most'))
-    assertRaises(FlexmockError, object.__getattribute__(e, 'one_by_one'))
+    assertRaises(FlexmockError, getattr, e, 'ordered')
+    assertRaises(FlexmockError, getattr, e, 'at_least')
+    assertRaises(FlexmockError, getattr, e, 'at_most')
+    assertRaises(FlexmockError, getattr, e, 'one_by_one')
+
+  def test_fluent_modifiers_work_with_and_without_parens(self):
+    mock = flexmock()
+    e1 = mock.should_receive('foo').with_args(1).at_least.once.ordered
+    e2 = mock.should_receive('foo').with_args(2).at_least().once().ordered()
+    for e in (e1, e2):
+      assertEqual((1, flexmock.UNLIMITED_CALLS), (e._min_calls, e._max_calls))
+      assertEqual(True, e._ordered)
+      assert e.mock is mock
+    assert type(e1).__getattribute__ is object.__getattribute__
+    mock.foo(1)
+    mock.foo(2)
 
   def test_and_return_defaults_to_none_with_no_arguments(self):
     foo = flexmock()
@@ -1488,6 +1975,27 @@ class RegularClass(object):
     assertEqual(False, _isproperty(Bar, 'baz'))
     assertEqual(False, _isproperty(Mock(), 'baz'))
 
+  def test_class_attribute_lookups_follow_changes(self):
+    class Foo(object):
+      @staticmethod
+      def bar(): return 'bar'
+    class Bar(Foo): pass
+    assertEqual((Foo, Foo.__dict__['bar']),
+                flexmock._get_class_attribute(Bar, 'bar'))
+    flexmock(Bar).should_receive('bar').and_return('baz')
+    assertEqual('baz', Bar.bar())
+    assertEqual(Bar, flexmock._get_class_attribute(Bar, 'bar')[0])
+    self._tear_down()
+    assertEqual((Foo, Foo.__dict__['bar']),
+                flexmock._get_class_attribute(Bar, 'bar'))
+    Bar.bar = staticmethod(lambda: 'qux')
+    assertEqual(Bar, flexmock._get_class_attribute(Bar, 'bar')[0])
+    class Baz(Bar): pass
+    class Qux(Baz): pass
+    assertEqual(False, _isproperty(Qux, 'bar'))
+    Baz.bar = property(lambda self: 'baz')
+    assertEqual(True, _isproperty(Qux, 'bar'))
+
   def test_fake_object_supporting_iteration(self):
     foo = flexmock()
     foo.should_receive('__iter__').and_yield(1, 2, 3)
@@ -1533,6 +2041,105 @@ class RegularClass(object):
     e = flexmock(Foo).should_receive('bar')
     assertRaises(MethodSignatureError, e.with_args, 1, 2, 3, c=2)
 
+  def test_with_args_reuses_cached_signature_for_same_code(self):
+    def make_class():
+      class Foo(object):
+        def bar(self, a, b, c=1): pass
+      return Foo
+    Foo1, Foo2 = make_class(), make_class()
+    e1 = flexmock(Foo1).should_receive('bar').with_args(1, 2)
+    e2 = flexmock(Foo2).should_receive('bar').with_args(1, 2, c=3)
+    assert e1._signature is e2._signature
+    assertEqual(('self', 'a', 'b', 'c'), e1._signature.positional_names)
+    assertRaises(MethodSignatureError, e2.with_args, 1, 2, d=2)
+
+  def test_introspection_cache_persists_argspecs(self):
+    directory = tempfile.mkdtemp()
+    try:
+      cache = flexmock.enable_introspection_cache(directory)
+      def func(a, b=1, *kargs): pass
+      code = func.__code__
+      assertEqual(None, cache.get_argspec(code, func))
+      flexmock._signature_cache.pop(code, None)
+      flexmock._get_signature(func)
+      flexmock.disable_introspection_cache()
+      cache = flexmock.IntrospectionCache(directory)
+      argspec = cache.get_argspec(code, func)
+      assertEqual(['a', 'b'], argspec.args)
+      assertEqual('kargs', argspec.varargs)
+      assertEqual((1,), argspec.defaults)
+    finally:
+      flexmock.disable_introspection_cache()
+      shutil.rmtree(directory)
+
+  def test_signatures_of_functions_sharing_a_decorator_are_kept_apart(self):
+    if sys.version_info < (3, 3):
+      return
+    import inspect
+    def decorate(func):
+      def wrapper(*kargs, **kwargs):
+        return func(*kargs, **kwargs)
+      wrapper.__signature__ = inspect.signature(func)
+      return wrapper
+    class Foo(object):
+      @decorate
+      def one(self, a): pass
+      @decorate
+      def two(self, a, b, c): pass
+    directory = tempfile.mkdtemp()
+    try:
+      flexmock.enable_introspection_cache(directory)
+      for i in range(2):
+        flexmock(Foo).should_receive('one').with_args(1)
+        flexmock(Foo).should_receive('two').with_args(1, 2, 3)
+        assertRaises(MethodSignatureError,
+                     flexmock(Foo).should_receive('one').with_args, 1, 2, 3)
+        self._tear_down()
+    finally:
+      flexmock.disable_introspection_cache()
+      shutil.rmtree(directory)
+
+  def test_introspection_cache_tells_functions_on_one_line_apart(self):
+    directory = tempfile.mkdtemp()
+    try:
+      cache = flexmock.enable_introspection_cache(directory)
+      one, two = lambda self, a: a, lambda self, a, b: b
+      for func in (one, two):
+        flexmock._signature_cache.pop(func.__code__, None)
+        flexmock._get_signature(func)
+      flexmock.disable_introspection_cache()
+      cache = flexmock.IntrospectionCache(directory)
+      assertEqual(['self', 'a'], cache.get_argspec(one.__code__, one).args)
+      assertEqual(['self', 'a', 'b'],
+                  cache.get_argspec(two.__code__, two).args)
+      other = lambda self, b: b
+      cache.store_argspec(other.__code__, flexmock.FullArgSpec(
+          (['self', 'a'], None, None, None, [], None, {})))
+      assertEqual(None, cache.get_argspec(other.__code__, other))
+    finally:
+      flexmock.disable_introspection_cache()
+      shutil.rmtree(directory)
+
+  def test_runner_hooks_wait_for_runner_import(self):
+    directory = tempfile.mkdtemp()
+    hooked = []
+    finder = flexmock._RunnerHookFinder(
+        {'flexmock_fake_runner': hooked.append})
+    try:
+      open(os.path.join(directory, 'flexmock_fake_runner.py'), 'w').close()
+      sys.path.insert(0, directory)
+      sys.meta_path.insert(0, finder)
+      assertEqual([], hooked)
+      import flexmock_fake_runner
+      assertEqual([flexmock_fake_runner], hooked)
+      assert finder not in sys.meta_path
+    finally:
+      if finder in sys.meta_path:
+        sys.meta_path.remove(finder)
+      sys.path.remove(directory)
+      sys.modules.pop('flexmock_fake_runner', None)
+      shutil.rmtree(directory)
+
   def test_with_args_blows_up_on_invalid_kwarg(self):
     class Foo(object):
       def bar(self, a, b, c=1): pass
@@ -1581,6 +2188,25 @@ class RegularClass(object):
     flexmock(foo).should_receive('bar').with_args(a=1,b=2,c=3).once()
     foo.bar(1, 2, c=3)
 
+  def test_calling_with_extra_positional_args_matches_mock_with_varargs(self):
+    class Foo(object):
+      def bar(self, a, *kargs): pass
+    foo = Foo()
+    flexmock(foo).should_receive('bar').with_args(1, 2).and_return('ok')
+    assertRaises(MethodSignatureError, foo.bar, 1, 3)
+    flexmock(foo).should_receive('bar').with_args(1, 2).and_return('ok').once()
+    assertEqual('ok', foo.bar(1, 2))
+
+  def test_arguments_matcher_checks_equality_class_and_regex(self):
+    matcher = flexmock.ArgumentsMatcher(
+        {'kargs': (1, str), 'kwargs': {'c': re.compile('^ba')}})
+    assertEqual(True, matcher.match((1, 'x'), {'c': 'bar'}))
+    assertEqual(False, matcher.match((2, 'x'), {'c': 'bar'}))
+    assertEqual(False, matcher.match((1, 2), {'c': 'bar'}))
+    assertEqual(False, matcher.match((1, 'x'), {'c': 'foo'}))
+    assertEqual(False, matcher.match((1, 'x'), {'d': 'bar'}))
+    assertEqual(False, matcher.match((1,), {'c': 'bar'}))
+
   def test_use_replace_with_for_callable_shortcut_kwargs(self):
     class Foo(object):
       def bar(self): return 'bar'
@@ -1661,5 +2287,60 @@ if sys.version_info >= (3, 0):
           1)
 
 
+if sys.version_info >= (3, 6):
+  import py36_only_features
+
+  def run_to_completion(coroutine):
+    """Runs a coroutine that must not need the event loop to finish."""
+    try:
+      coroutine.send(None)
+    except StopIteration:
+      return sys.exc_info()[1].value
+    raise AssertionError('coroutine suspended')
+
+  class TestPy36Features(unittest.TestCase):
+    def tearDown(self):
+      flexmock_teardown()
+
+    def test_should_receive_on_coroutine_function_returns_awaitable(self):
+      flexmock(py36_only_features).should_receive('async_add').and_return(5)
+      self.assertEqual(5, run_to_completion(py36_only_features.await_value(
+          py36_only_features.async_add(1, 2))))
+
+    def test_should_receive_on_coroutine_method_raises_when_awaited(self):
+      instance = py36_only_features.AsyncClass()
+      flexmock(instance).should_receive('method').and_raise(KeyError)
+      flexmock(py36_only_features.AsyncClass).should_receive(
+          'static_method').and_return(None)
+      awaitable = instance.method(1)
+      self.assertRaises(KeyError, run_to_completion,
+                        py36_only_features.await_value(awaitable))
+      self.assertEqual(None, run_to_completion(py36_only_features.await_value(
+          py36_only_features.AsyncClass.static_method(1))))
+
+    def test_and_yield_on_async_generator_function(self):
+      flexmock(py36_only_features).should_receive('async_count').and_yield(
+          'a', 'b')
+      self.assertEqual(['a', 'b'], run_to_completion(
+          py36_only_features.collect(py36_only_features.async_count(5))))
+
+    def test_should_call_on_coroutine_function_checks_awaited_result(self):
+      flexmock(py36_only_features).should_call('async_add').and_return(3)
+      self.assertEqual(3, run_to_completion(py36_only_features.await_value(
+          py36_only_features.async_add(1, 2))))
+      self.assertRaises(MethodSignatureError, run_to_completion,
+                        py36_only_features.await_value(
+                            py36_only_features.async_add(2, 2)))
+
+    def test_should_call_on_coroutine_function_checks_awaited_exception(self):
+      flexmock(py36_only_features).should_call('async_fail').and_raise(
+          ValueError, 'boom')
+      run_to_completion(py36_only_features.await_value(
+          py36_only_features.async_fail('boom')))
+      self.assertRaises(ExceptionMessageError, run_to_completion,
+                        py36_only_features.await_value(
+                            py36_only_features.async_fail('bang')))
+
+
 if __name__ == '__main__':
   unittest.main()
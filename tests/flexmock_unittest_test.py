@@ -9,5 +9,8 @@ if sys.version_info >= (2, 6):
 if sys.version_info >= (3,0):
   from flexmock_test import TestPy3Features
 
+if sys.version_info >= (3, 6):
+  from flexmock_test import TestPy36Features
+
 if __name__ == '__main__':
   unittest.main()
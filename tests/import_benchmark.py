@@ -0,0 +1,45 @@
+"""Measures how long importing flexmock takes in a fresh interpreter.
+
+Usage:
+  python tests/import_benchmark.py [runs] [module_to_import_first ...]
+
+e.g. `python tests/import_benchmark.py 20 unittest` times the import with
+unittest already loaded, as it would be when running under unittest.
+"""
+import os
+import subprocess
+import sys
+
+
+SCRIPT = """
+import sys, time
+for name in sys.argv[1:]:
+  __import__(name)
+start = time.time()
+import flexmock
+sys.stdout.write('%f' % (time.time() - start))
+"""
+
+
+def time_import(preload=()):
+  env = dict(os.environ)
+  path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  env['PYTHONPATH'] = os.pathsep.join(
+      [path] + [p for p in [env.get('PYTHONPATH')] if p])
+  output = subprocess.check_output(
+      [sys.executable, '-c', SCRIPT] + list(preload), env=env)
+  return float(output)
+
+
+def main(argv):
+  runs = 10
+  if argv:
+    runs = int(argv[0])
+  preload = argv[1:]
+  times = sorted(time_import(preload) for _ in range(runs))
+  print('flexmock import over %d runs: min %.2fms, median %.2fms' % (
+      runs, times[0] * 1000, times[len(times) // 2] * 1000))
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
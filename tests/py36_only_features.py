@@ -0,0 +1,28 @@
+async def async_add(a, b):
+  return a + b
+
+
+async def async_fail(message):
+  raise ValueError(message)
+
+
+async def async_count(n):
+  for i in range(n):
+    yield i
+
+
+class AsyncClass(object):
+  async def method(self, a):
+    return a * 2
+
+  @staticmethod
+  async def static_method(a):
+    return a * 3
+
+
+async def await_value(awaitable):
+  return await awaitable
+
+
+async def collect(async_iterable):
+  return [value async for value in async_iterable]